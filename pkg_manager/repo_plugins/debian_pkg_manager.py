@@ -14,17 +14,46 @@ import pwd
 import grp
 import logging
 import httplib
+import socket
+import threading
+import multiprocessing
+import Queue
+import collections
 import datetime
+import time
+import email.utils
+import errno
 import gnupg
 import hashlib
 import StringIO
+import cPickle
+import json
+import re
 import gzip
 import bz2
+import mmap
+# xz support is optional under python 2 - it needs either the backports.lzma or the pyliblzma package.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 import api.updated_pkg_data
 
 
 logger = None
 
+# Read size used when hashing files on disk.
+hash_chunk_size = 1048576
+# Number of threads used to hash batches of files.
+hash_workers = max(1, min(8, multiprocessing.cpu_count()))
+# Size of the chunks package downloads are streamed to disk in.
+download_chunk_size = 65536
+# Hash fields of a Packages record, strongest first, with their hashlib names.
+package_hash_fields = (('SHA512', 'sha512'), ('SHA256', 'sha256'), ('SHA1', 'sha1'), ('MD5sum', 'md5'))
+
 
 def initialize(name, opts_dict):
     """
@@ -62,7 +91,13 @@ class DebianPkgManager:
 
         # Non-config file specified variables.
         self.whitelist = {}
+        # Compiled whitelists (see whitelist_matcher), keyed by (component, category.)
+        self.whitelist_matchers = {}
         self.release_contents = {}
+        # Pool files fetched during the current sync, keyed by (remote Filename, hash value).
+        self.sync_downloads = {}
+        # Whether the current sync has replaced (and so unlinked) any existing pool file.
+        self.pool_files_replaced = False
 
         # Config file specified variables.
         try:
@@ -184,6 +219,37 @@ class DebianPkgManager:
         except KeyError:
             self.package_field_order = []
 
+        # download_workers and mirror_connections are optional - they set how many packages are downloaded at once, and
+        # how many of those downloads may be made from any one mirror.
+        try:
+            download_workers = int(opts_dict['download_workers'])
+        except KeyError:
+            download_workers = 4
+        try:
+            mirror_connections = int(opts_dict['mirror_connections'])
+        except KeyError:
+            mirror_connections = 2
+        # blob_store is optional - when set, it names a directory under the pkg_manager root that holds one copy of
+        # every pool file, keyed by SHA256, which the pools of all repositories using it hardlink to.
+        try:
+            self.blob_store = BlobStore(os.path.join(root, opts_dict['blob_store']))
+        except KeyError:
+            self.blob_store = None
+
+        # Hashes of the files in the pool, so that files already present need not be downloaded or hashed again.
+        self.pool_manifest = HashManifest(os.path.join(self.cache_dir, self.generate_cache_filename('pool_manifest')))
+        # Hashes of the files listed in the local Release file, so that only changed files are hashed again.
+        self.release_manifest = HashManifest(os.path.join(self.cache_dir,
+                                                          self.generate_cache_filename('release_manifest')))
+        # Measured mirror performance, used to pick the mirrors that downloads go to.
+        self.mirror_stats = MirrorStats(os.path.join(self.cache_dir, self.generate_cache_filename('mirror_stats')))
+        self.package_downloader = PackageDownloader(self.urls, self.mirror_stats, download_workers,
+                                                    mirror_connections)
+
+        # ETag/Last-Modified values of the cached Release and index files, for conditional downloads.
+        self.download_validators = DownloadValidators(os.path.join(self.cache_dir,
+                                                                   self.generate_cache_filename('validators')))
+
     def sync(self):
         """
         Attempts to update the local repository copy against the contents of the remote repository.  Refreshes the
@@ -209,17 +275,26 @@ class DebianPkgManager:
         if not success:
             logger.error("All mirrors failed to return a valid remote Release index, or remote Release file "
                          "has not been updated.  Sync will halt.")
+            connection_pool.close_all()
             return None
 
         success = self.parse_cached_release()
 
         if not success:
             logger.error("Unable to parse the local cached Release file.  Cannot proceed with sync.")
+            connection_pool.close_all()
             return None
 
         # Release files have been updated - load our whitelist.
         self.read_whitelist()
 
+        # Architecture: all packages turn up in every binary-<arch> index with the same Filename; remember which pool
+        # files this sync has already fetched so that each one is only downloaded once.
+        self.sync_downloads = {}
+        self.pool_files_replaced = False
+        # Indices that were fully synced; they are only recorded as such once the Release file lists them.
+        synced_indexes = []
+
         # Now to start on the Packages, Source and i18n indices, and the actual package updates.
         for component in self.component_list:
             # get the list of categories in each component, iterate over them...
@@ -229,55 +304,60 @@ class DebianPkgManager:
                 # we're getting the Packages indices and updating the local binary package files; source we get
                 # the source indices etc.
                 if category == 'binary':
-                    # Update the cached Package index files for all binary categories.
-                    self.update_cached_pkg_index(component, category)
+                    # Indices whose Release entries and whitelist are unchanged since they were last synced need no
+                    # work at all.
+                    whitelist_digest = self.whitelist_digest(component)
+                    changed_archs = []
+                    release_entries = {}
+                    for arch in self.arch_list:
+                        full_category = 'binary-' + arch
+                        release_entries[arch] = self.release_index_entries(component, full_category)
+                        if self.index_unchanged(component, full_category, release_entries[arch], whitelist_digest):
+                            logger.info('Packages index for component {0}, category {1} is unchanged since the '
+                                        'last sync.  Skipping.'.format(component, full_category))
+                        else:
+                            changed_archs.append(arch)
+
+                    if not changed_archs:
+                        continue
+
+                    # Update the cached Package index files for all changed binary categories.  If any download
+                    # failed we may be working from stale caches, so nothing is recorded as synced this time.
+                    cache_updated = self.update_cached_pkg_index(component, False, changed_archs)
 
                     # Now read in the cached Package value against the whitelist contents to get a trimmed list
                     # of packages whose versions we can compare against our local install base.
-                    for arch in self.arch_list:
+                    for arch in changed_archs:
                         full_category = 'binary-' + arch
                         logger.debug('Beginning local Package file update for repo {0}, '
                                      'component {1}, category {2}.'.format(self.root, component, full_category))
 
                         remote_pkg_filename = self.generate_cache_filename('Packages', component, full_category)
                         remote_pkg_path = os.path.join(self.cache_dir, remote_pkg_filename)
-                        remote_pkg_list = self.read_pkg_index_file(remote_pkg_path)
-
-                        # Clear non-whitelisted packages from the remote_pkg_list.
-                        remote_pkg_list = self.apply_whitelist(remote_pkg_list, component, category)
 
                         # Now we need to read in the local repository's Package object, if it exists.
-                        local_pkg_glob = os.path.join(self.repo_dir, component, full_category, 'Packages*')
-                        pkg_glob = glob.glob(local_pkg_glob)
-
-                        # It doesn't really matter which one we open, but if there's an uncompressed version
-                        # available we have so much less to do, so that's our default.
-                        if local_pkg_glob[:-1] in pkg_glob:
-                            local_pkg_path = local_pkg_glob[:-1]
-                        elif local_pkg_glob[:-1] + '.bz2' in pkg_glob:
-                            local_pkg_path = local_pkg_glob[:-1] + '.bz2'
-                        elif local_pkg_glob[:-1] + '.gz' in pkg_glob:
-                            local_pkg_path = local_pkg_glob[:-1] + '.gz'
-                        else:
-                            logger.error('No Packages file of recognizable compression '
-                                         'type in {0}'.format(local_pkg_glob[:-1]))
-                            local_pkg_path = ''
-
-                        # Read in the local package cache, if one exists.
-                        if local_pkg_path:
-                            local_pkg_list = self.read_pkg_index_file(local_pkg_path)
-                        else:
-                            local_pkg_list = {}
+                        local_pkg_list = self.read_local_pkg_index(component, full_category)
+
+                        # Only the whitelisted stanzas of the (uncompressed) cached index are parsed, one at a time
+                        # and in name order.  Dependencies with alternatives are resolved in favour of packages we
+                        # already mirror.
+                        remote_records = self.iter_mapped_pkg_index(remote_pkg_path, component, category,
+                                                                    local_pkg_list)
+                        if remote_records is None:
+                            logger.error('Unable to read cached Packages file {0}.  Skipping component {1}, '
+                                         'category {2}.'.format(remote_pkg_path, component, full_category))
+                            continue
 
                         # Now compare the whitelisted packages against the local packages, and update the local
-                        # packages as required.
-                        updated_list = self.compare_pkg_versions(remote_pkg_list, local_pkg_list)
+                        # packages as required.  Only the records that need updating are kept.
+                        updated_list = self.compare_pkg_versions(remote_records, local_pkg_list)
 
                         # Add the new packages to the updated_pkg_data list for returning to the calling framework.
                         self.record_updates(updated_list, updated_pkg_data, full_category)
 
                         # Now actually pull down the packages in the updated_list.
                         local_pkg_list = self.update_local_repository(updated_list, local_pkg_list)
+                        self.mirror_stats.save()
 
                         # And write out the component/binary-arch/Packages files.
                         success = self.write_package_index(local_pkg_list, component, full_category)
@@ -287,9 +367,38 @@ class DebianPkgManager:
                                          'failed.  Please investigate.'.format(component, full_category))
                             # Not much we can do - the original Package file will still be in place and
                             # pointing to old packages, so nothing corrupted.  continue on...
+                        elif cache_updated and all(local_pkg_list.get(package['Package']) is package
+                                                   for package in updated_list):
+                            # Every update made it into the local index, so this index can be skipped until
+                            # either upstream or the whitelist changes - provided the Release file is written.
+                            synced_indexes.append((component, full_category, release_entries[arch],
+                                                   whitelist_digest))
+
+        # After all of the individual index files are created, we need to generate a new Release file - unless no
+        # index has changed since the last Release was successfully written and signed.
+        if self.release_dirty() or not os.path.isfile(os.path.join(self.repo_dir, 'Release')) or \
+                not os.path.isfile(os.path.join(self.repo_dir, 'Release.gpg')):
+            release_written = self.generate_new_local_release()
+            if release_written:
+                self.clear_release_dirty()
+            else:
+                logger.error('Unable to write the local Release file; it will be regenerated on the next sync.')
+        else:
+            logger.debug('No local index changed; keeping the current Release file.')
+            release_written = True
+
+        # Until a signed Release lists them, the synced indices must be looked at again on the next sync.
+        if release_written:
+            for index_state in synced_indexes:
+                self.record_index_state(*index_state)
 
-        # After all of the individual index files are created, we need to generate a new Release file.
-        self.generate_new_local_release()
+        # Drop any blobs that no pool links to any more.  Pool files are only ever unlinked by being replaced, so
+        # unless that happened this sync there is nothing for the (full) walk of the store to find.
+        if self.blob_store is not None and self.pool_files_replaced:
+            self.blob_store.gc()
+
+        # Keep-alive connections are only worth keeping within a sync; don't leave them open until the next one.
+        connection_pool.close_all()
 
         return updated_pkg_data
 
@@ -331,6 +440,8 @@ class DebianPkgManager:
 
         # Create a list of all of the directories we should have.
         dir_structure = [self.root, self.cache_dir, self.pool_dir, self.repo_dir]
+        if self.blob_store is not None:
+            dir_structure.append(self.blob_store.root)
 
         # Cover the components and categories...
         for component in self.component_list:
@@ -358,10 +469,13 @@ class DebianPkgManager:
     def read_whitelist(self):
         """
         When called, opens and reads the whitelist file at the location defined by self.whitelist, and reads it in to
-        create the local whitelist data structure.
+        create the local whitelist data structure.  Besides plain package names, an entry may be a glob (e.g.
+        linux-image-*) or a regular expression between slashes (e.g. /^python3-(six|yaml)$/); see WhitelistMatcher.
         :return:
         """
 
+        self.whitelist_matchers = {}
+
         try:
             fd = open(self.whitelist_file, 'r')
         except IOError as err:
@@ -462,20 +576,178 @@ class DebianPkgManager:
             # category list if the package is already in the whitelist - we just overwrite it.
             pkg_dict[pkg_name] = component_category_dict[component]
 
+        self.whitelist_matchers = {}
+
+    def whitelist_matcher(self, component, category):
+        """
+        :param component: The component whose whitelist we want.
+        :param category: The category the whitelist entries must be enabled for.
+        :return: The WhitelistMatcher for component and category, compiled on first use.
+        """
+
+        try:
+            return self.whitelist_matchers[(component, category)]
+        except KeyError:
+            matcher = WhitelistMatcher(self.whitelist.get(component, {}), category)
+            self.whitelist_matchers[(component, category)] = matcher
+            return matcher
+
+    def whitelist_digest(self, component):
+        """
+        Produces a digest of everything about the whitelist that affects which packages of component are mirrored,
+        so that a change to the whitelist can be detected between syncs.
+        :param component: The component whose whitelist we want a digest of.
+        :return: A hex digest string.
+        """
+
+        whitelist = self.whitelist.get(component, {})
+        hasher = hashlib.sha256(str(self.whitelist_override))
+        for name in sorted(whitelist):
+            hasher.update('{0}\t{1}\n'.format(name, ','.join(sorted(whitelist[name]))))
+
+        return hasher.hexdigest()
+
+    def release_index_entries(self, component, category):
+        """
+        Collects the Release file entries (under the strongest hash the Release file offers) for every variant of the
+        Packages index of component and category.
+        :param component: The name of the component the Packages index belongs to.
+        :param category: The complete category name (e.g. binary-amd64.)
+        :return: A sorted list of [hash, size, path] entries; empty if the Release file lists none.
+        """
+
+        for hash_type in ['SHA256', 'SHA1', 'MD5Sum']:
+            if hash_type in self.release_contents:
+                break
+        else:
+            return []
+
+        path_prefix = component + '/' + category + '/Packages'
+
+        return sorted(list(index) for index in self.release_contents[hash_type] if index[2].startswith(path_prefix))
+
+    def release_dirty(self):
+        """
+        Checks whether a local index has been rewritten since the local Release file was last successfully written
+        and signed.  The flag is kept in the cache directory, so a Release that failed to generate (or a sync that
+        died before reaching it) is retried on the next sync even if no index changes then.
+        :return: True if the Release file needs to be regenerated; False otherwise.
+        """
+
+        return os.path.isfile(os.path.join(self.cache_dir, self.generate_cache_filename('release_dirty')))
+
+    def mark_release_dirty(self):
+        """
+        Records that a local index is being rewritten, so the local Release file no longer lists its hashes.
+        :return:
+        """
+
+        flag_path = os.path.join(self.cache_dir, self.generate_cache_filename('release_dirty'))
+        if os.path.isfile(flag_path):
+            return
+
+        stream = open(flag_path, 'w+')
+        stream.close()
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(flag_path, owner, group)
+
+    def clear_release_dirty(self):
+        """
+        Records that the local Release file matches the local indexes again.
+        :return:
+        """
+
+        try:
+            os.unlink(os.path.join(self.cache_dir, self.generate_cache_filename('release_dirty')))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def load_index_state(self):
+        """
+        Reads the record of the Release entries and whitelist digest that each Packages index was last synced
+        against from the cache directory.
+        :return: Dictionary keyed by component/category.  Empty if no state has been saved yet.
+        """
+
+        state_path = os.path.join(self.cache_dir, self.generate_cache_filename('index_state'))
+
+        try:
+            stream = open(state_path, 'r')
+            state = json.load(stream)
+            stream.close()
+        except (IOError, ValueError):
+            return {}
+
+        return state
+
+    def index_unchanged(self, component, category, release_entries, whitelist_digest):
+        """
+        Checks whether a Packages index was last synced against the same Release entries and whitelist, and the
+        local Packages index produced by that sync is still in place.
+        :param component: The name of the component the Packages index belongs to.
+        :param category: The complete category name (e.g. binary-amd64.)
+        :param release_entries: The current Release entries for the index, as returned by release_index_entries.
+        :param whitelist_digest: The current digest of the component's whitelist.
+        :return: True if the index does not need to be synced again; False otherwise.
+        """
+
+        if not release_entries:
+            return False
+
+        previous = self.load_index_state().get(component + '/' + category)
+        if previous is None:
+            return False
+
+        if previous['release'] != release_entries or previous['whitelist'] != whitelist_digest:
+            return False
+
+        return os.path.isfile(os.path.join(self.repo_dir, component, category, 'Packages'))
+
+    def record_index_state(self, component, category, release_entries, whitelist_digest):
+        """
+        Records that a Packages index has been fully synced against release_entries and whitelist_digest.
+        :param component: The name of the component the Packages index belongs to.
+        :param category: The complete category name (e.g. binary-amd64.)
+        :param release_entries: The Release entries for the index, as returned by release_index_entries.
+        :param whitelist_digest: The digest of the component's whitelist.
+        :return:
+        """
+
+        state_path = os.path.join(self.cache_dir, self.generate_cache_filename('index_state'))
+
+        state = self.load_index_state()
+        state[component + '/' + category] = {'release': release_entries, 'whitelist': whitelist_digest}
+
+        try:
+            stream = open(state_path, 'w+')
+            json.dump(state, stream)
+            stream.close()
+        except IOError:
+            logger.error('Unable to save index state file {0}.'.format(state_path))
+            return
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(state_path, owner, group)
+
     # def update_cached_package(self, component, category, force=False):
-    def update_cached_pkg_index(self, component, force=False):
+    def update_cached_pkg_index(self, component, force=False, arch_list=None):
         """
         Given a component and category name, the method uses the release data to identify the smallest (most highly
         compressed) Packages index with the strongest level of cryptohash available, and if it has been updated
         more recently than the existing local cache, proceeds to download the newest version.
         :param component: The name of the component whose Package index file we want to update.
         :param force: Method will attempt to download Package file regardless of value of local timestamp.
+        :param arch_list: The architectures whose Packages files should be updated; defaults to all supported ones.
         :return: True if the Package file was updated; False in all other cases.
         """
 
         # Identify the type of category first.  If binary, we need to examine all of the architectures supported...
         # if category == 'binary':
-        category = ['binary-' + arch for arch in self.arch_list]
+        category = ['binary-' + arch for arch in (arch_list if arch_list is not None else self.arch_list)]
         # else:
         #    # To simplify our processing strategy, just turn category into a list of length 1.
         #    category = [category]
@@ -504,16 +776,25 @@ class DebianPkgManager:
             logger.debug('Local Packages file given cache name {0}, '
                          'in path {1}'.format(local_package_name, self.cache_dir))
 
-            # Get the timestamp on the local cache.
-            if (not force) and os.path.isfile(local_package_path):
+            # If the mirror publishes incremental diffs, patching the cached copy is far cheaper than a full download.
+            if self.update_cached_pkg_index_pdiff(component, item, hash_type):
+                continue
+
+            # Get the timestamp on the local cache, so that the download is made conditional.  If the Release file
+            # lists the uncompressed Packages file, the pdiff attempt above has already found the cache to be out of
+            # date, and a conditional request could only waste the round trip.
+            uncompressed_listed = any(index[2] == component + '/' + item + '/Packages'
+                                      for index in self.release_contents[hash_type])
+            if (not force) and (not uncompressed_listed) and os.path.isfile(local_package_path):
                 local_ts = datetime.datetime.fromtimestamp(os.path.getmtime(local_package_path))
                 logger.debug('Cached Packages file exists with timestamp {0}'.format(local_ts))
             else:
                 local_ts = None
+            unchanged = False
 
             # All of the following work needs to be done in the anticipation of a failed download from the remote
             # source.  So we loop over this until one of the URLs has a working entry.
-            for url in self.urls[:]:
+            for url in self.mirror_stats.rank(self.urls):
                 # and the start of the path to the packages file.
                 path_prefix = component + '/' + item + '/Packages'
                 logger.debug('Path prefix for search is: {0}'.format(path_prefix))
@@ -530,7 +811,8 @@ class DebianPkgManager:
                     logger.debug('Examining release_contents key {0}, index entry {1}'.format(hash_type, index))
 
                     if index[2].startswith(path_prefix) and \
-                            (index[2].endswith('.bz2') or index[2].endswith('.gz') or index[2].endswith('Packages')):
+                            (index[2].endswith('.bz2') or index[2].endswith('.gz') or index[2].endswith('Packages') or
+                             (index[2].endswith('.xz') and lzma is not None)):
                         logger.debug('Index points to Packages file for this component:category.  Testing size.')
                         for i in range(0, len(best_pkg_index)):
                             if int(index[1]) < int(best_pkg_index[i][1]):
@@ -544,8 +826,8 @@ class DebianPkgManager:
                             best_pkg_index.append(index)
 
                 if len(best_pkg_index) < 1:
-                    logger.error('No Packages file of type bz2, gzip or uncompressed listed in Release file.  Cannot '
-                                 'continue with Package file update.')
+                    logger.error('No Packages file of type xz, bz2, gzip or uncompressed listed in Release file.  '
+                                 'Cannot continue with Package file update.')
                     return False
 
                 # The best_pkg_index will now point to a list of index files.  This one we want to download.  We need
@@ -556,12 +838,26 @@ class DebianPkgManager:
                 for package in best_pkg_index:
                     pkg_path = self.remote_release_path.strip('Release') + package[2]
                     logger.debug('Attempting to download {0}'.format(pkg_path))
+                    # A 304 can only vouch for the cache if the cache was verified against this very Release entry;
+                    # otherwise a lagging mirror could keep an index the current Release no longer lists.
+                    entry = self.download_validators.get(url, pkg_path)
+                    if entry is not None and entry.get('release_hash') == package[0]:
+                        request_ts = local_ts
+                    else:
+                        request_ts = None
                     try:
-                        raw_pkg_data = download_file(url, pkg_path, local_ts)
+                        reply = download_file_with_validators(url, pkg_path, request_ts, self.download_validators,
+                                                              self.mirror_stats)
                     except httplib.HTTPException:
                         logger.error('Unable to download file {1} from {0}.  Trying next...'.format(pkg_path, url))
                         continue
 
+                    if reply is None:
+                        logger.debug('Remote file {0} has not changed since it was cached.'.format(pkg_path))
+                        unchanged = True
+                        break
+                    raw_pkg_data, etag, last_modified = reply
+
                     # So we don't have to loop ALL the rest of the method, get the successfully downloaded file
                     # type now.
                     filename_bits = package[2].split('.')
@@ -578,6 +874,9 @@ class DebianPkgManager:
                                  'exist in the remote repository.  Exiting with error.'.format(component, item))
                     return False
 
+                if unchanged:
+                    break
+
                 # Now to check the signature on the downloaded file and ensure it matches what our verified Release
                 # entry says it should be.
                 if hash_type == 'SHA256':
@@ -591,21 +890,29 @@ class DebianPkgManager:
 
                 # If the provided hash does not match the hash from downloading,
                 if hash_obj.hexdigest() != hash_value:
-                    logger.error('Package file {0} at URL {1} hash value {2} did not match the hash value {3}'
+                    logger.error('Package file {0} at URL {1} hash value {2} did not match the hash value {3} '
                                  'in the Release file.  Removing URL as potentially tainted.'
-                                 ''.format(best_pkg_index[2], url, hash_obj.hexdigest, best_pkg_index[0]))
+                                 ''.format(package[2], url, hash_obj.hexdigest(), hash_value))
                     self.urls.remove(url)
                     # Try again with the next URL.
                     continue
                 else:
+                    # Only a verified download may be vouched for by a later 304, and only under this Release entry.
+                    self.download_validators.update(url, pkg_path, etag, last_modified, hash_value)
                     break
             else:
                 logger.error('Tried all URLs in url list; none had a valid Packages file present.  Exiting...')
                 return False
 
+            # The cached copy is still current; nothing to write.
+            if unchanged:
+                continue
+
             # Otherwise, write out the contents of the file (note that if it is zipped, we want to unzip it.
             # Decompress data before writing out, if necessary.
-            if file_type == 'bz2':
+            if file_type == 'xz':
+                pkg_data = lzma.decompress(raw_pkg_data)
+            elif file_type == 'bz2':
                 pkg_data = bz2.decompress(raw_pkg_data)
             elif file_type == 'gz':
                 fd = gzip.GzipFile(fileobj=StringIO.StringIO(raw_pkg_data))
@@ -626,11 +933,121 @@ class DebianPkgManager:
             group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
             os.chown(local_package_path, owner, group)
 
+        return True
+
+    def update_cached_pkg_index_pdiff(self, component, category, hash_type):
+        """
+        Brings the cached (uncompressed) Packages file for a component and category up to date by applying the chain of
+        ed-style patches published under Packages.diff/, rather than downloading the whole index again; if the Index
+        says the patches are merged, only the one patch for the cached file is applied.  The Index of the patches is
+        verified against the Release file, each patch against the Index, and the patched result against the Release
+        file's hash for the uncompressed Packages file before it replaces the cached copy.
+        :param component: The name of the component whose Packages file we want to update.
+        :param category: The complete category name (e.g. binary-amd64.)
+        :param hash_type: The strongest hash type present in the Release file.
+        :return: True if the cached Packages file is now current; False if the caller needs to fall back to a full
+        download (no cached copy, no diffs published, the patch chain does not connect to the cached copy, or no
+        mirror could supply a patch chain that produces the index the Release file lists.)
+        """
+
+        local_package_path = os.path.join(self.cache_dir, self.generate_cache_filename('Packages', component, category))
+        if not os.path.isfile(local_package_path):
+            return False
+
+        hash_name = {'SHA256': 'sha256', 'SHA1': 'sha1', 'MD5Sum': 'md5'}[hash_type]
+        release_hashes = dict((index[2], index[0]) for index in self.release_contents[hash_type])
+        index_path = component + '/' + category + '/Packages.diff/Index'
+        packages_path = component + '/' + category + '/Packages'
+
+        # Without the hash of the uncompressed Packages file there is nothing to verify the patched result against.
+        if packages_path not in release_hashes:
+            logger.debug('Release does not list {0}; no incremental update.'.format(packages_path))
+            return False
+
+        if hash_file(local_package_path, hash_name) == release_hashes[packages_path]:
+            logger.debug('Cached Packages file {0} is already current.'.format(local_package_path))
+            return True
+
+        if index_path not in release_hashes:
+            logger.debug('Release does not list {0}; no incremental update.'.format(index_path))
+            return False
+
+        remote_dir = self.remote_release_path.strip('Release') + component + '/' + category + '/Packages.diff/'
+
+        for url in self.mirror_stats.rank(self.urls):
+            try:
+                index_data = download_file(url, remote_dir + 'Index', stats=self.mirror_stats)
+            except httplib.HTTPException:
+                logger.debug('Unable to download {0}Index from {1}.'.format(remote_dir, url))
+                continue
+
+            if hashlib.new(hash_name, index_data).hexdigest() != release_hashes[index_path]:
+                logger.error('Packages.diff/Index from {0} does not match the Release file.  '
+                             'Trying next...'.format(url))
+                continue
+
+            pdiff_index = parse_pdiff_index(index_data)
+            if pdiff_index is None:
+                logger.debug('Packages.diff/Index from {0} lists no usable patch hashes.'.format(url))
+                return False
+
+            # Locate the cached file in the patch history.  Server-merged patches each take their file straight to
+            # the current one; otherwise every patch from there on has to be applied in order.
+            current_hash = hash_file(local_package_path, pdiff_index['hash'])
+            history = [entry[2] for entry in pdiff_index['history'] if entry[0] == current_hash]
+            if not history:
+                logger.debug('Cached Packages file {0} is not in the patch history.'.format(local_package_path))
+                return False
+            if pdiff_index['merged']:
+                chain = history[-1:]
+            else:
+                names = [entry[2] for entry in pdiff_index['history']]
+                chain = names[names.index(history[0]):]
+
+            stream = open(local_package_path, 'r')
+            lines = stream.readlines()
+            stream.close()
+
+            try:
+                for name in chain:
+                    patch_data = download_file(url, remote_dir + name + '.gz', stats=self.mirror_stats)
+                    patch = gzip.GzipFile(fileobj=StringIO.StringIO(patch_data)).read()
+                    if hashlib.new(pdiff_index['hash'], patch).hexdigest() != pdiff_index['patches'][name][0]:
+                        raise ValueError('Patch {0} does not match its Packages.diff/Index entry.'.format(name))
+                    apply_ed_patch(lines, patch)
+            except (httplib.HTTPException, socket.error, IOError, KeyError, ValueError) as err:
+                logger.error('Unable to apply the patch chain from {0}: {1}.  Trying next...'.format(url, err))
+                continue
+
+            pkg_data = ''.join(lines)
+            if hashlib.new(hash_name, pkg_data).hexdigest() != release_hashes[packages_path]:
+                logger.error('Packages file for component {0}, category {1} patched from {2} does not match the '
+                             'Release file.  Trying next...'.format(component, category, url))
+                continue
+
+            # Replace the cached file in one step so that a failure never leaves a half written index behind.
+            temp_path = local_package_path + '.tmp'
+            stream = open(temp_path, 'w+')
+            stream.write(pkg_data)
+            stream.close()
+            os.rename(temp_path, local_package_path)
+
+            owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+            group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+            os.chown(local_package_path, owner, group)
+
+            logger.debug('Applied {0} patches to cached Packages file {1}.'.format(len(chain), local_package_path))
+            return True
+
+        return False
+
     def update_cached_release(self, force=False):
         """
         Looks for a local copy of the Release file and, if present, extracts the files last modified date and time.
         Will do the same thing for the Release.gpg file.  Calls download_file with the remote repository path and
-        the last modified time, then saves the file into the cache directory with a unique filename.
+        the last modified time, then saves the file into the cache directory with a unique filename.  Every mirror is
+        asked, and of the copies that pass signature verification the one with the newest Date field is kept - so a
+        mirror that is lagging behind can never replace a newer Release, however quickly it answers.
         :param force: If it is necessary to redownload the Release file for some reason (e.g. a later step finds one
         of the Package or source index files to be compromised, meaning the mirror cannot be trusted) then setting
         force to True will make the method download the Release file regardless of the state of the cached version.
@@ -641,93 +1058,149 @@ class DebianPkgManager:
         logger.debug('Cached Release file will be named {0}'.format(cached_release))
         cached_release_sig = self.generate_cache_filename('Release.gpg')
         logger.debug('Cached Release signature file will be named {0}'.format(cached_release_sig))
+        cached_release_path = os.path.join(self.cache_dir, cached_release)
+        cached_release_sig_path = os.path.join(self.cache_dir, cached_release_sig)
         local_ts = None
-        retval = False
+        cached_date = None
 
         # Check if the local cached copies exist and get the timestamp if they do, or if force is enabled then
         # set up for required download.
-        if (not force) and os.path.isfile(os.path.join(self.cache_dir, cached_release)):
-            local_ts = datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(self.cache_dir, cached_release)))
+        if (not force) and os.path.isfile(cached_release_path):
+            local_ts = datetime.datetime.fromtimestamp(os.path.getmtime(cached_release_path))
             logger.debug("Release file has modified date and time of {0}".format(local_ts))
+            stream = open(cached_release_path, 'r')
+            cached_date = release_date(stream.read())
+            stream.close()
 
-        # Iterate over our URLs, trying each one in turn until either a) we have determined the Release file has not
-        # changed, or b) it has changed, and we have downloaded and cryptographically verified the validity of the
-        # downloaded Release file.
-        for url in self.urls[:]:
+        # Every mirror is asked at once; the replies (which all feed the mirror statistics) are taken in the order
+        # they arrive.  Each new Release file is verified against the signature from the same URL, and the newest of
+        # the verified copies wins.
+        candidates = []
+        unchanged = 0
+        for url, reply in self.race_release_download(local_ts):
             logger.debug('Trying url {0}.'.format(url))
-            # Make a shot at pulling down the Release file.
-            release_data = download_file(url, self.remote_release_path, local_ts)
 
-            # If the remote copy is not newer than the local copy, there is nothing for us to do.
-            if release_data is None:
-                logger.debug('None returned for release_data - either the download failed or the remote file has'
-                             'not been updated.')
-                return False
+            # This mirror's copy is no newer than the cached one; others may still have something newer.
+            if reply is None:
+                logger.debug('None returned for release_data - the remote file at {0} has not been '
+                             'updated.'.format(url))
+                unchanged += 1
+                continue
+            release_data, etag, last_modified = reply
 
             logger.debug('Data returned for Release file - acquiring signature file.')
-            # If release_data is not None, then Release has been updated and we have pulled down the file.  Get
-            # the signature too.  Don't bother with the timestamp - we need the newest copy.
-            release_sig_data = download_file(url, self.remote_release_path + '.gpg')
-
-            # Write both out to cache.
-            logger.debug('Writing file {0} to disk.'.format(os.path.join(self.cache_dir, cached_release)))
-            fd = open(os.path.join(self.cache_dir, cached_release), 'w+')
-            fd.write(release_data)
-            fd.close()
+            try:
+                release_sig_data = download_file(url, self.remote_release_path + '.gpg', stats=self.mirror_stats)
+            except (httplib.HTTPException, socket.error) as err:
+                logger.error('Unable to download the Release signature from {0}: {1}'.format(url, err))
+                continue
 
-            # Change release file owner to default.
-            owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
-            group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
-            os.chown(os.path.join(self.cache_dir, cached_release), owner, group)
+            if not self.verify_release(release_data, release_sig_data):
+                logger.error('The Release file from {0} failed verification against its gpg signature.  Deleting '
+                             'URL from list as potentially tainted.'.format(url))
+                self.urls.remove(url)
+                continue
+
+            # Mirrors that answered first are preferred among copies of the same date.
+            candidates.append((release_date(release_data), -len(candidates), url, release_data, release_sig_data,
+                               etag, last_modified))
+
+        self.mirror_stats.save()
+
+        if not candidates:
+            if unchanged:
+                logger.debug('The remote Release file has not been updated.')
+            else:
+                logger.error('All downloaded Release files from all URLs provided have failed verification.  Unable '
+                             'to continue.')
+            return False
+
+        date, order, url, release_data, release_sig_data, etag, last_modified = max(candidates)
+        if cached_date is not None and (date is None or date <= cached_date):
+            logger.debug('No mirror has a Release file newer than the cached copy.')
+            return False
 
-            logger.debug('Writing file {0} to disk.'.format(os.path.join(self.cache_dir, cached_release_sig)))
-            fd = open(os.path.join(self.cache_dir, cached_release_sig), 'w+')
-            fd.write(release_sig_data)
+        logger.debug('Using the Release file from {0}.'.format(url))
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        for path, data in ((cached_release_path, release_data), (cached_release_sig_path, release_sig_data)):
+            logger.debug('Writing file {0} to disk.'.format(path))
+            fd = open(path, 'w+')
+            fd.write(data)
             fd.close()
+            os.chown(path, owner, group)
 
-            owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
-            group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
-            os.chown(os.path.join(self.cache_dir, cached_release_sig), owner, group)
+        self.download_validators.update(url, self.remote_release_path, etag, last_modified)
 
-            # Now to verify the signature with one of the keys in the public keyring.
-            pubring = conf.pkg_manager.public_keyring if conf.pkg_manager.public_keyring != '' else None
+        return True
 
-            gpg = gnupg.GPG(gnupghome=conf.pkg_manager.keypath, keyring=pubring)
+    def verify_release(self, release_data, release_sig_data):
+        """
+        Verifies a Release file against its detached signature with the keys in the public keyring.
+        :param release_data: The contents of the Release file.
+        :param release_sig_data: The contents of the Release.gpg file.
+        :return: True if the signature is valid.
+        """
 
-            logger.debug('Attempting to verify Release file {0} with signature {1}...'.format(
-                os.path.join(self.cache_dir, cached_release_sig),
-                os.path.join(self.cache_dir, cached_release)
-            ))
+        # The verify_data method requires a path to the sig file, but takes data in memory...
+        sig_path = os.path.join(self.cache_dir, self.generate_cache_filename('Release.gpg') + '.verify')
+        fd = open(sig_path, 'w+')
+        fd.write(release_sig_data)
+        fd.close()
 
-            # The verify_data method requires a path to the sig file, but takes data in memory...
-            verification = gpg.verify_data(os.path.join(self.cache_dir, cached_release_sig),
-                                           release_data)
+        pubring = conf.pkg_manager.public_keyring if conf.pkg_manager.public_keyring != '' else None
+        gpg = gnupg.GPG(gnupghome=conf.pkg_manager.keypath, keyring=pubring)
 
-            if not verification:
-                logger.error('The Release file {0} failed verification against '
-                             'gpg checksum {1}'.format(cached_release, cached_release_sig))
-                os.remove(os.path.join(self.cache_dir, cached_release_sig))
-                os.remove(os.path.join(self.cache_dir, cached_release))
-                logger.error('Deleting URL from list as potentially tainted.')
-                self.urls.remove(url)
-            else:
-                logger.debug('The Release file {0} has been successfully verified '
-                             'by gpg_checksum {1}.'.format(cached_release, cached_release_sig))
-                retval = True
-                break
-        else:
-            logger.error('All downloaded Release files from all URLs provided have failed verification.  Unable to '
-                         'continue.')
+        try:
+            return bool(gpg.verify_data(sig_path, release_data))
+        finally:
+            os.remove(sig_path)
 
-        return retval
+    def race_release_download(self, local_ts):
+        """
+        Requests the Release file from every URL at once, so that no mirror's reply waits on another's; every reply
+        feeds the mirror statistics, which is what ranks the mirrors for the downloads that follow.  The generator
+        only finishes once every request has completed, so no request is left running behind the caller.
+        :param local_ts: The modified time of the cached Release file, or None, as for download_file.
+        :return: Generator of (url, reply) tuples in the order the downloads complete, where reply is as returned by
+        download_file_with_validators: None if the remote Release file has not changed.  URLs whose download failed are
+        skipped.
+        """
+
+        results = Queue.Queue()
+
+        def fetch(url):
+            try:
+                results.put((url, download_file_with_validators(url, self.remote_release_path, local_ts,
+                                                                self.download_validators, self.mirror_stats)))
+            except (httplib.HTTPException, socket.error) as err:
+                logger.error('Unable to download the Release file from {0}: {1}'.format(url, err))
+                results.put((url, err))
+            except Exception as err:
+                # Every request has to report back, or the generator would wait for it forever.
+                logger.error('Unexpected error downloading the Release file from {0}: {1}'.format(url, err))
+                results.put((url, err))
+
+        urls = self.urls[:]
+        for url in urls:
+            thread = threading.Thread(target=fetch, args=(url,))
+            thread.daemon = True
+            thread.start()
+
+        for i in range(len(urls)):
+            url, reply = results.get()
+            if isinstance(reply, Exception):
+                continue
+            yield url, reply
 
     def generate_new_local_release(self):
         """
         Creates a new local release file and signs it; all directories under the Release file path are searched for
-        files.  Each found file is hashed (MD5, SHA1 and SHA256) and the hashes, file size, and path relative to Release
-        file directory are stored in the Release file.  The Release file is then signed by the private key specified
+        files.  Each found file is hashed (MD5, SHA1 and SHA256, reusing the release_manifest hashes of files that have
+        not changed since the last run) and the hashes, file size, and path relative to Release file directory are
+        stored in the Release file.  The Release file is then signed by the private key specified
         in the configuration.
-        :return:
+        :return: True if the Release file was written and signed; False otherwise.
         """
 
         logger.debug('Generating a new local Release file and signing it.')
@@ -753,44 +1226,46 @@ class DebianPkgManager:
             logger.warn('Release.gpg file does ont exist in {0} - possible problem if '
                         'this is not a new repository.'.format(self.repo_dir))
 
-        # Now recurse through subdirectories and identify all files for the Release output.
-        files = []
+        # Now recurse through subdirectories and identify all files for the Release output.  Only files that are new
+        # or have changed since the last Release was generated need hashing; the rest come from the release_manifest.
+        requests = []
         while len(search_paths) > 0:
-            # Set up our hash libraries.
-            md5_hasher = hashlib.md5()
-            sha1_hasher = hashlib.sha1()
-            sha256_hasher = hashlib.sha256()
-
             # Pull the first item off the list.
             file_object = search_paths.pop(0)
 
             # Check if file or directory.
             if os.path.isfile(file_object):
                 logger.debug('{0} is a file.'.format(file_object))
-                stream = open(file_object, 'r')
-                data = stream.read()
-                stream.close()
-
-                md5_hasher.update(data)
-                md5_hash = md5_hasher.hexdigest()
-                sha1_hasher.update(data)
-                sha1_hash = sha1_hasher.hexdigest()
-                sha256_hasher.update(data)
-                sha256_hash = sha256_hasher.hexdigest()
-                logger.debug('Hashes for {0} have been generated.'.format(file_object))
-
-                size = os.stat(file_object).st_size
-                logger.debug('File size of {0} is {1}.'.format(file_object, size))
-
-                # Store our data in a list, data order md5, sha1, sha256, file size, and file path.
-                # we need the file path relative to the Release file, NOT the whole thing!!
-                files.append([md5_hash, sha1_hash, sha256_hash, size, os.path.relpath(file_object, self.repo_dir)])
+                requests.append((file_object, ('md5', 'sha1', 'sha256'), os.stat(file_object)))
             elif os.path.isdir(file_object):
                 sub_items = glob.glob(os.path.join(file_object, '*'))
                 logger.debug('{0} is a directory; the following items are contained '
                              'in it: {1}'.format(file_object, sub_items))
                 search_paths.extend(sub_items)
 
+        # Changed files are hashed in parallel.
+        all_hashes = self.release_manifest.get_hashes_many(requests)
+
+        files = []
+        hashed_paths = []
+        for file_object, hash_types, stat_result in requests:
+            hashes = all_hashes[file_object]
+            if hashes is None:
+                logger.error('Unable to read {0}; leaving it out of the Release file.'.format(file_object))
+                continue
+            hashed_paths.append(file_object)
+
+            size = stat_result.st_size
+            logger.debug('File size of {0} is {1}.'.format(file_object, size))
+
+            # Store our data in a list, data order md5, sha1, sha256, file size, and file path.
+            # we need the file path relative to the Release file, NOT the whole thing!!
+            files.append([hashes['md5'], hashes['sha1'], hashes['sha256'], size,
+                          os.path.relpath(file_object, self.repo_dir)])
+
+        self.release_manifest.prune(hashed_paths)
+        self.release_manifest.save()
+
         # All files have been identified and secure hashed; results are stored in files list.
         # Now we need to write out a modified selection of the Release data.  Specifically, the Date,
         # Architectures, Components, MD5Sum, SHA1, and SHA256 fields need to be updated with our data.
@@ -862,6 +1337,9 @@ class DebianPkgManager:
         gpg = gnupg.GPG(gnupghome=homedir, keyring=pubring, secret_keyring=secring)
 
         signature_data = gpg.sign(release_str, keyid=keyname, passphrase=password, detach=True)
+        if not signature_data:
+            logger.error('Unable to sign Release file {0}: {1}'.format(release_file, signature_data.status))
+            return False
 
         # And write the signature file.
         try:
@@ -884,6 +1362,9 @@ class DebianPkgManager:
         """
         Given a dictionary representation of a package index file, write the package index out into the correct
         subdirectory (determined by the component and category parameters.)
+        The index is rendered once and each format is compressed on its own thread, written to a temporary file and
+        renamed into place, so clients never see a partly written index.  If the rendered index is identical to the
+        Packages file already on disk, nothing is rewritten.
         :param pkg_index: dictionary of packages, key is package name, value is the dictionary of the actual package
         fields.
         :param component: The name of the component that the Packages file is a part of.
@@ -891,7 +1372,7 @@ class DebianPkgManager:
         category name (e.g. binary-amd64) and not just the binary- prefix, as the Packages file is unique to each
         such category.
         :return: True if the Packages file could be written in at least one form (uncompressed, compressed with gzip,
-        or compressed with bzip2.)
+        compressed with bzip2, or compressed with xz when an lzma module is available), or was already current.
                  False if the Packages file could not be written at all.
         """
 
@@ -914,159 +1395,299 @@ class DebianPkgManager:
                 os.chown(temp, owner, group)
                 temp = os.path.split(temp)[0]
 
-        # We want to write out uncompressed, gzip and bzip2 so that client software has tons of flexibility.
-        # Do uncompressed first.
-        try:
-            unc_stream = open(os.path.join(packages_path, 'Packages'), 'w+')
-        except IOError:
-            logger.error('Unable to open file {0} for uncompressed writing.'.format(packages_path + '/Packages'))
-            unc_stream = None
-        try:
-            gzip_stream = gzip.GzipFile(os.path.join(packages_path, 'Packages.gz'), 'w')
-        except IOError:
-            logger.error('Unable to open file {0} for gzip writing.'.format(packages_path + '/Packages.gz'))
-            gzip_stream = None
-        try:
-            bz2_stream = bz2.BZ2File(os.path.join(packages_path, 'Packages.bz2'), 'w')
-        except IOError:
-            logger.error('Unable to open file {0} for bzip2 writing.'.format(packages_path + '/Packages.bz2'))
-            bz2_stream = None
-
-        if unc_stream is None and gzip_stream is None and bz2_stream is None:
-            logger.error('No output stream could be opened to write the Packages file out.  Terminating attempt.')
+        # Render the whole index once; every output format is written from the same bytes.
+        data = self.render_package_index(pkg_index)
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        # We want to write out uncompressed, gzip, bzip2 and (with an lzma module) xz so that client software has tons
+        # of flexibility.
+        formats = [('Packages', None), ('Packages.gz', 'gz'), ('Packages.bz2', 'bz2')]
+        if lzma is not None:
+            formats.append(('Packages.xz', 'xz'))
+
+        # If the index has not changed at all there is nothing to rewrite, recompress or re-hash into Release.
+        unc_path = os.path.join(packages_path, 'Packages')
+        if all(os.path.isfile(os.path.join(packages_path, name)) for name, compression in formats) and \
+                (self.release_manifest.lookup(unc_path, 'sha256') or hash_file(unc_path)) == content_hash:
+            logger.debug('Packages index {0} is unchanged; leaving it in place.'.format(unc_path))
+            if not os.path.isfile(self.local_index_snapshot_path(component, category)):
+                self.write_local_index_snapshot(pkg_index, component, category, content_hash)
+            return True
+
+        # The Release file stops matching the moment any format is replaced; flag it before touching anything.
+        self.mark_release_dirty()
+
+        # Each format is compressed and published on its own thread.
+        results = {}
+
+        def write_format(name, compression):
+            # Anything escaping the thread would leave no result at all for the format.
+            results[name] = False
+            try:
+                results[name] = write_index_file(os.path.join(packages_path, name), data, compression)
+            except Exception as err:
+                logger.error('Unexpected error writing {0}: {1}'.format(os.path.join(packages_path, name), err))
+
+        threads = [threading.Thread(target=write_format, args=format_spec) for format_spec in formats]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not any(results.values()):
+            logger.error('The Packages file could not be written out in any form.')
             return False
 
-        # All three file streams created.  Now to turn pkg_index into text and output records.
-        # Might as well go ahead and sort our lookups by package name.
-        pkg_names = sorted(pkg_index.keys())
+        # The snapshot can only be validated against the uncompressed Packages file, so only keep one if it was written.
+        if results.get('Packages'):
+            self.write_local_index_snapshot(pkg_index, component, category, content_hash)
+        else:
+            self.remove_local_index_snapshot(component, category)
+
+        return True
+
+    def render_package_index(self, pkg_index):
+        """
+        Renders a package index into the text of a Packages file: one stanza per package, in package name order.
+        Package records are written out as the stanza they were read from, with only their Filename patched; other
+        records, and all records when package_field_order is set, are written with the fields in package_field_order
+        first and any remaining fields after them in record order.
+        :param pkg_index: dictionary of packages, key is package name, value is the package record.
+        :return: The Packages file contents.
+        """
 
-        # iterate over the pkg_index keys (e.g. package names.)
-        for name in pkg_names:
-            logger.debug('Writing record for package {0} out.'.format(name))
+        stanzas = []
+        for name in sorted(pkg_index.keys()):
             package = pkg_index[name]
 
-            # Use the package-field-list to create our output string, if it exists.
-            out_str = ''
+            # Upstream stanzas are passed through as read - unless the administrator has asked for a specific field
+            # order.
+            if isinstance(package, PackageRecord):
+                if not self.package_field_order:
+                    stanzas.append(package.stanza_text() + '\n')
+                    continue
+                field_text = package.field_text
+            else:
+                field_text = lambda field: field + ': ' + package[field] + '\n'
+
+            # Use the package-field-list to create our output lines, if it exists.
+            lines = []
             for field in self.package_field_order:
                 try:
-                    out_str += field + ': ' + package[field] + '\n'
-                # Remove the field from the package on completion.
-                    package.pop(field)
+                    lines.append(field_text(field))
                 except KeyError:
                     logger.debug('Package {0} missing user-specified field {1}.  Leaving out.'.format(name, field))
 
-            logger.debug('Outputting any remaining fields in arbitrary order.')
             # Now, in case there are still fields in the package that have not been output:
             for field in package:
-                out_str += field + ': ' + package[field] + '\n'
-                # Above we removed the field, but we don't need to do that here.
-
-            logger.debug('Finished creating output string.  Writing out to file now...')
-            # Add a closing \n to the out_str so the next record written is double spaced, and write it.
-            out_str += '\n'
-
-            if unc_stream:
-                logger.debug('Writing uncompressed...')
-                unc_stream.write(out_str)
-            if gzip_stream:
-                logger.debug('Writing gzip compressed...')
-                gzip_stream.write(out_str)
-            if bz2_stream:
-                logger.debug('Writing bzip2 compressed...')
-                bz2_stream.write(out_str)
-
-        if unc_stream:
-            unc_stream.close()
-        if gzip_stream:
-            gzip_stream.close()
-        if bz2_stream:
-            bz2_stream.close()
+                if field not in self.package_field_order:
+                    lines.append(field_text(field))
 
-        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
-        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
-        os.chown(os.path.join(packages_path, 'Packages'), owner, group)
-        os.chown(os.path.join(packages_path, 'Packages.gz'), owner, group)
-        os.chown(os.path.join(packages_path, 'Packages.bz2'), owner, group)
+            # A closing \n so the next record written is double spaced.
+            lines.append('\n')
+            stanzas.append(''.join(lines))
 
-        return True
+        return ''.join(stanzas)
 
-    def update_local_repository(self, update_list, local_pkg_index):
+    def read_local_pkg_index(self, component, category):
         """
-        Reads each Package record out of the update_list one at a time, identifies the remote path information and
-        pulls the file down from the remote mirror and stores it in the local pool (using the tail of the remote
-        path, if not the entire thing.)  The saved data is hashed by md5, sha1 and sha256 and then the new path
-        and hashes are updated in the package object.  The modified package object is saved into the local_pkg_index.
-        :param update_list: List of packages to update.
-        :param local_pkg_index: Dictionary of all packages that the local repository houses.
-        :return: Returns the local_pkg_index on success.
-                 Returns None if an error occurs during processing.
+        Reads the local repository's own Packages index for a component and category.  The snapshot saved by
+        write_package_index is used when it still matches the uncompressed Packages file on disk; otherwise the
+        Packages file (uncompressed by preference, then xz, bzip2 and gzip) is parsed.
+        :param component: The name of the component that the Packages file is a part of.
+        :param category: The complete category name (e.g. binary-amd64) that the Packages file is a part of.
+        :return: Dictionary of package records keyed by package name.  Empty if no local index exists yet.
         """
 
-        logger.debug('Updating local repository; {0} packages have changed or been added.'.format(len(update_list)))
+        local_pkg_glob = os.path.join(self.repo_dir, component, category, 'Packages*')
 
-        for package in update_list:
-            # The package Filename attribute is relative to the top of the remote repository - we can just pass
-            # the two parts to download_file.
-            # Iterate over the URLs
-            logger.debug('Attempting to update package {0}'.format(package['Filename']))
-            for url in self.urls[:]:
-                # Try to download the remote package.
-                pkg_data = download_file(url, package['Filename'])
-                if 'SHA256' in package:
-                    logger.debug('Selected SHA256 as hash verification function.')
-                    hash_func = hashlib.sha256()
-                    hash_value = package['SHA256']
-                elif 'SHA1' in package:
-                    logger.debug('Selected SHA1 as hash verification function')
-                    hash_func = hashlib.sha1()
-                    hash_value = package['SHA1']
-                elif 'MD5sum' in package:
-                    logger.debug('Selected MD5 as hash verification function.')
-                    hash_func = hashlib.md5()
-                    hash_value = package['MD5sum']
-                else:
-                    logger.debug('Unknown secure hash associated with package {0}.  '
-                                 'Rejecting package..'.format(package['Package']))
-                    continue
+        pkg_index = self.read_local_index_snapshot(component, category, local_pkg_glob[:-1])
+        if pkg_index is not None:
+            return pkg_index
 
-                hash_func.update(pkg_data)
-                dl_hash_value = hash_func.hexdigest()
+        pkg_glob = glob.glob(local_pkg_glob)
 
-                # If the hash value of the downloaded file does not match the expected value from the package record,
-                # reject this package and try the next URL.
-                if hash_value != dl_hash_value:
-                    logger.error('Downloaded copy of package {0} does not produce correct hash value.  '
-                                 'Expected {1}, produced {2}'.format(package['Filename'], hash_value, dl_hash_value))
-                    continue
+        # It doesn't really matter which one we open, but if there's an uncompressed version
+        # available we have so much less to do, so that's our default.
+        if local_pkg_glob[:-1] in pkg_glob:
+            local_pkg_path = local_pkg_glob[:-1]
+        elif local_pkg_glob[:-1] + '.xz' in pkg_glob and lzma is not None:
+            local_pkg_path = local_pkg_glob[:-1] + '.xz'
+        elif local_pkg_glob[:-1] + '.bz2' in pkg_glob:
+            local_pkg_path = local_pkg_glob[:-1] + '.bz2'
+        elif local_pkg_glob[:-1] + '.gz' in pkg_glob:
+            local_pkg_path = local_pkg_glob[:-1] + '.gz'
+        else:
+            logger.error('No Packages file of recognizable compression '
+                         'type in {0}'.format(local_pkg_glob[:-1]))
+            return {}
 
-                # If we get here, then hash_value must equal dl_hash_value and we move on.
-                break
-            else:
-                logger.error('No URL was able to provide a valid copy of package '
-                             '{0}.  Skipping.'.format(package['Filename']))
-                continue
-                # If the hash value of the downloaded file match the expected value from the update list, save it
-                # to the local pool.
+        pkg_index = self.read_pkg_index_file(local_pkg_path)
 
-            # Need to remove the remote pool path from the package, and ensure the path has no leading '/'
-            path = package['Filename']
+        return pkg_index if pkg_index is not None else {}
 
-            # If the path in the package has the remote pool root at the base, then we want to yank that out.
-            if path.startswith(self.remote_pool_root):
-                local_path = path[len(self.remote_pool_root) + 1:]
-            else:
-                local_path = path
-            # and add our own local pool path to the package file path.
-            full_path = os.path.join(self.pool_dir, local_path)
+    def local_index_snapshot_path(self, component, category):
+        return os.path.join(self.cache_dir, self.generate_cache_filename('Packages.snapshot', component, category))
 
-            # Check to make sure we actually have a local directory path to the file's resting place:
-            temp = os.path.split(full_path)[0]
-            if not os.path.exists(temp):
-                os.makedirs(temp, conf.pkg_manager.default_perms)
+    def write_local_index_snapshot(self, pkg_index, component, category, content_hash):
+        """
+        Serializes pkg_index into the cache directory, tagged with the SHA256 of the uncompressed Packages file that
+        was written from it, so that the next sync can load the local index without parsing that file.
+        :param pkg_index: Dictionary of package records keyed by package name.
+        :param component: The name of the component that the Packages file is a part of.
+        :param category: The complete category name (e.g. binary-amd64) that the Packages file is a part of.
+        :param content_hash: The SHA256 hex digest of the uncompressed Packages file.
+        :return: True if the snapshot was written; False otherwise.
+        """
 
-                # Change ownership of directories.
-                owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] \
-                    if conf.pkg_manager.default_owner else -1
+        snapshot_path = self.local_index_snapshot_path(component, category)
+
+        try:
+            stream = open(snapshot_path, 'wb')
+            cPickle.dump({'sha256': content_hash, 'format': PackageRecord.state_version, 'records': pkg_index},
+                         stream, cPickle.HIGHEST_PROTOCOL)
+            stream.close()
+        except (IOError, cPickle.PicklingError) as err:
+            logger.error('Unable to write local index snapshot {0}: {1}'.format(snapshot_path, err))
+            self.remove_local_index_snapshot(component, category)
+            return False
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(snapshot_path, owner, group)
+
+        return True
+
+    def read_local_index_snapshot(self, component, category, packages_file):
+        """
+        Loads the local index snapshot for component and category, provided that it was taken from the current
+        contents of packages_file.
+        :param component: The name of the component that the Packages file is a part of.
+        :param category: The complete category name (e.g. binary-amd64) that the Packages file is a part of.
+        :param packages_file: Path to the uncompressed local Packages file the snapshot must match.
+        :return: Dictionary of package records keyed by package name, or None if there is no valid snapshot.
+        """
+
+        snapshot_path = os.path.join(self.cache_dir,
+                                     self.generate_cache_filename('Packages.snapshot', component, category))
+
+        if not os.path.isfile(snapshot_path) or not os.path.isfile(packages_file):
+            return None
+
+        try:
+            stream = open(snapshot_path, 'rb')
+            snapshot = cPickle.load(stream)
+            stream.close()
+        except Exception as err:
+            # A truncated or otherwise unreadable snapshot is not an error - we just fall back to parsing.
+            logger.warn('Unable to load local index snapshot {0}: {1}'.format(snapshot_path, err))
+            return None
+
+        if snapshot.get('format') != PackageRecord.state_version:
+            logger.debug('Local index snapshot {0} has an older record layout; parsing instead.'.format(snapshot_path))
+            return None
+
+        if hash_file(packages_file) != snapshot.get('sha256'):
+            logger.debug('Local index snapshot {0} does not match {1}; parsing instead.'.format(snapshot_path,
+                                                                                               packages_file))
+            return None
+
+        logger.debug('Loaded {0} records from local index snapshot {1}.'.format(len(snapshot['records']),
+                                                                               snapshot_path))
+
+        return snapshot['records']
+
+    def remove_local_index_snapshot(self, component, category):
+        """
+        Deletes the local index snapshot for component and category, if there is one.
+        """
+
+        snapshot_path = os.path.join(self.cache_dir,
+                                     self.generate_cache_filename('Packages.snapshot', component, category))
+        if os.path.isfile(snapshot_path):
+            os.remove(snapshot_path)
+
+    def update_local_repository(self, update_list, local_pkg_index):
+        """
+        Reads each Package record out of the update_list, identifies the remote path information and hands the
+        packages to the package_downloader, which pulls them down from the remote mirrors concurrently and stores them
+        in the local pool (using the tail of the remote path, if not the entire thing.)  Packages are streamed to disk
+        and verified against the strongest hash in their record before they are moved into place.  As each download
+        completes, the new path is updated in the package object and the modified package object is saved into the
+        local_pkg_index.  Packages that are already in the pool with the right size and hash (per the pool_manifest),
+        or that have already been fetched during this sync for another architecture, are not downloaded again; only
+        their index entries are rebuilt.
+        :param update_list: List of packages to update.
+        :param local_pkg_index: Dictionary of all packages that the local repository houses.
+        :return: Returns the local_pkg_index on success.
+                 Returns None if an error occurs during processing.
+        """
+
+        logger.debug('Updating local repository; {0} packages have changed or been added.'.format(len(update_list)))
+
+        candidates = []
+        jobs = []
+        # Packages sharing a pool file with a package that is already queued, keyed by (remote Filename, hash value).
+        duplicates = {}
+        for package in update_list:
+            logger.debug('Queueing update of package {0}'.format(package['Filename']))
+            for hash_field, hash_type in package_hash_fields:
+                if hash_field in package:
+                    logger.debug('Selected {0} as hash verification function.'.format(hash_field))
+                    hash_value = package[hash_field]
+                    break
+            else:
+                logger.error('Unknown secure hash associated with package {0}.  '
+                             'Rejecting package..'.format(package['Package']))
+                continue
+
+            key = (package['Filename'], hash_value)
+            if key in self.sync_downloads:
+                logger.debug('Package {0} has already been fetched this sync.'.format(package['Filename']))
+                self.index_pool_package(package, self.sync_downloads[key], local_pkg_index)
+                continue
+            if key in duplicates:
+                duplicates[key].append(package)
+                continue
+
+            # Need to remove the remote pool path from the package, and ensure the path has no leading '/'
+            path = package['Filename']
+
+            # If the path in the package has the remote pool root at the base, then we want to yank that out.
+            if path.startswith(self.remote_pool_root):
+                local_path = path[len(self.remote_pool_root) + 1:]
+            else:
+                local_path = path
+            # and add our own local pool path to the package file path.
+            full_path = os.path.join(self.pool_dir, local_path)
+
+            candidates.append((package, key, full_path, hash_type, hash_value))
+            duplicates[key] = []
+
+        # Files already in the pool are verified in one parallel batch.
+        current = self.pool_files_current(candidates)
+
+        for package, key, full_path, hash_type, hash_value in candidates:
+            if full_path in current:
+                logger.debug('Package {0} is already in the pool; skipping download.'.format(full_path))
+                self.sync_downloads[key] = full_path
+                for duplicate in duplicates[key]:
+                    self.index_pool_package(duplicate, full_path, local_pkg_index)
+                self.index_pool_package(package, full_path, local_pkg_index)
+                continue
+
+            # Whatever is at full_path now is about to be replaced, which may leave a blob unreferenced.
+            if os.path.lexists(full_path):
+                self.pool_files_replaced = True
+
+            # Check to make sure we actually have a local directory path to the file's resting place:
+            temp = os.path.split(full_path)[0]
+            if not os.path.exists(temp):
+                os.makedirs(temp, conf.pkg_manager.default_perms)
+
+                # Change ownership of directories.
+                owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] \
+                    if conf.pkg_manager.default_owner else -1
                 group = grp.getgrnam(conf.pkg_manager.default_group)[2] \
                     if conf.pkg_manager.default_group else -1
                 while temp != self.pool_dir:
@@ -1074,127 +1695,134 @@ class DebianPkgManager:
                     os.chown(temp, owner, group)
                     temp = os.path.split(temp)[0]
 
-            # Directories are now properly owned and secured.  Go ahead with saving the data.
-            file_stream = open(full_path, 'w+')
-            file_stream.write(pkg_data)
-            file_stream.close()
+            # Another repository sharing the blob store may already have fetched this very file.
+            if self.blob_store is not None and 'SHA256' in package and \
+                    self.blob_store.link(package['SHA256'], full_path):
+                logger.debug('Linked package {0} from the blob store; skipping download.'.format(full_path))
+                self.pool_manifest.record(full_path, hash_type, hash_value)
+                self.sync_downloads[key] = full_path
+                for duplicate in duplicates[key]:
+                    self.index_pool_package(duplicate, full_path, local_pkg_index)
+                self.index_pool_package(package, full_path, local_pkg_index)
+                continue
+
+            jobs.append((package, full_path, hash_type, hash_value))
+
+        # The downloads themselves run in the downloader's worker threads; the local index is only ever updated from
+        # here, one completed download at a time.
+        for (package, full_path, hash_type, hash_value), success in self.package_downloader.run(jobs):
+            key = (package['Filename'], hash_value)
+            if not success:
+                logger.error('No URL was able to provide a valid copy of package '
+                             '{0}.  Skipping.'.format(package['Filename']))
+                continue
 
             owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
             group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
             os.chown(full_path, owner, group)
 
-            # We want the top of the pool directory relative to the root of the web-exposed directory.  The pool
-            # directory must sit below the web-exposed root, so if we remove that we'll be left only with the path
-            # to the pool directory.
-
-            logger.debug('Building relative path to package {0} from web_root {1}:'.format(full_path, self.web_root))
-            relative_path = os.path.relpath(full_path, self.web_root)
-            logger.debug('Relative path is: {0}'.format(relative_path))
+            if self.blob_store is not None and 'SHA256' in package:
+                self.blob_store.add(package['SHA256'], full_path)
 
-            # if self.web_root.endswith('/'):
-            #    relative_path = full_path[len(self.web_root):]
-            # else:
-            #    relative_path = full_path[len(self.web_root) + 1:]
+            self.pool_manifest.record(full_path, hash_type, hash_value)
+            self.sync_downloads[key] = full_path
+            for duplicate in duplicates[key]:
+                self.index_pool_package(duplicate, full_path, local_pkg_index)
+            self.index_pool_package(package, full_path, local_pkg_index)
 
-            # update the package object with the new filename, and then update the dictionary with the new
-            # package.
-            package['Filename'] = relative_path
-            local_pkg_index[package['Package']] = package
+        self.pool_manifest.save()
 
         # Return the updated local_pkg_index object.
         return local_pkg_index
 
-    def compare_pkg_versions(self, new_pkg_cont, old_pkg_cont):
+    def pool_files_current(self, candidates):
         """
-        Checks every entry in new_pkg_cont against the contents of old_pkg_cont.  Every package record in new_pkg_cont
-        that has a newer version string than what is in old_pkg_cont (or that does not exist in old_pkg_cont) is
-        marked and the package object is added to an updated_pkg list.
-        :param new_pkg_cont: The contents of a newer Packages file; must be dictionary with package names as keys
-        and the package data (also a dictionary) as the value.
-        :param old_pkg_cont:  The contents of an older Packages file; must be dictionary with package names as keys
-        and the package data (also a dictionary) as the value.
-        :return: A list object of packages from new_pkg_cont whose version is newer than (or for which no equivalent
-        package exists in) the old_pkg_cont.
+        Checks which packages the pool already holds a good copy of, e.g. because a previous sync downloaded them but
+        never got as far as writing the Packages file.  Each file's size is compared against its package record, and
+        its hash looked up in the pool_manifest; files the manifest has no current entry for are hashed, in parallel.
+        :param candidates: List of (package, key, full_path, hash_type, hash_value) tuples, as built by
+        update_local_repository.
+        :return: Set of the full_paths that hold their package.
         """
 
-        updated_list = []
-
-        logger.debug('Comparing package versions between the new Packages list and the old one.')
-        logger.debug('New packages list has {0} packages in it.'.format(len(new_pkg_cont)))
-        logger.debug('Old packages list has {0} packages in it.'.format(len(old_pkg_cont)))
-
-        # iterate over all objects in new_pkg_cont
-        for pkg_name, package in new_pkg_cont.iteritems():
-            new_version = package['Version']
+        requests = []
+        expected = {}
+        for package, key, full_path, hash_type, hash_value in candidates:
             try:
-                old_version = old_pkg_cont[pkg_name]['Version']
-            except:
-                # Trivial case - the package does not exist in old_pkg_cont.  Add it to updated list and move on.
-                logger.debug('Package {0} does not exist in old_pkg_cont - adding to update list.'.format(pkg_name))
-                updated_list.append(package)
+                stat_result = os.stat(full_path)
+            except OSError:
                 continue
 
-            if pkg_name == 'libcurl3-gnutls':
-                print('Comparing package {0}: new versions {1}, old version {2}'.format(pkg_name, new_version, old_version))
+            if 'Size' in package and str(stat_result.st_size) != package['Size'].strip():
+                continue
 
-            # Have the new version and the old version strings ready.
-            logger.debug("Comparing against new package %s, version %s.", pkg_name, new_version)
+            requests.append((full_path, (hash_type,), stat_result))
+            expected[full_path] = (hash_type, hash_value)
 
-            # if newest_ver.version.find(':') > 0:
-            new_epoch_end = new_version.find(':')
-            old_epoch_end = old_version.find(':')
-            new_epoch = int(new_version[:new_epoch_end]) if new_epoch_end >= 0 else 0
-            old_epoch = int(old_version[:old_epoch_end]) if old_epoch_end >= 0 else 0
+        current = set()
+        for full_path, digests in self.pool_manifest.get_hashes_many(requests).items():
+            hash_type, hash_value = expected[full_path]
+            if digests is not None and digests.get(hash_type) == hash_value:
+                current.add(full_path)
 
-            logger.debug("New package version epoch is %d", new_epoch)
-            logger.debug("Old package version epoch is %d", old_epoch)
+        return current
 
-            # debian spec dictates epoch is a single unsigned integer.  Convert to int to ensure numerical comparison.
-            if int(old_epoch) > int(new_epoch):
-                logger.debug("Old package epoch is larger; new package not newer version.  Checking next...")
-                continue
-            elif int(old_epoch) < int(new_epoch):
-                logger.debug("Old package epoch is smaller, so new package is newer version.  Marking package...")
-                updated_list.append(package)
-                continue
+    def index_pool_package(self, package, full_path, local_pkg_index):
+        """
+        Points a package record at its file in the local pool and saves it into the local_pkg_index.
+        :param package: The package record.
+        :param full_path: The path of the package in the local pool.
+        :param local_pkg_index: Dictionary of all packages that the local repository houses.
+        """
 
-            logger.debug("Epochs are equal.  Checking upstream version next.")
-            # Epoch comparison fails, move on to upstream component.
-            new_upstr_end = new_version.find('-', max(new_epoch_end, 0))
-            old_upstr_end = old_version.find('-', max(old_epoch_end, 0))
-            new_upstr_ver = new_version[new_epoch_end + 1:new_upstr_end] if new_upstr_end >= 0 \
-                else new_version[new_epoch_end + 1:]
-            old_upstr_ver = old_version[old_epoch_end + 1:old_upstr_end] if old_upstr_end >= 0 \
-                else old_version[old_epoch_end + 1:]
-
-            logger.debug("Newest package upstream version is %s.", new_upstr_ver)
-            logger.debug("Challenging package upstream version is %s.", old_upstr_ver)
-
-            # Test the package versions...
-            out = self.debian_version_compare(new_upstr_ver, old_upstr_ver)
-            logger.debug("Result of debian_compare: %s is the higher version.", out)
-
-            if out == new_upstr_ver:
-                updated_list.append(package)
-                logger.debug("New version is higher; replace newest and check next package.")
-                if pkg_name == 'libcurl3-gnutls':
-                    print('New version is higher; the new version has been added to the updated_list of package objects.')
-                continue
+        # We want the top of the pool directory relative to the root of the web-exposed directory.  The pool
+        # directory must sit below the web-exposed root, so if we remove that we'll be left only with the path
+        # to the pool directory.
+
+        logger.debug('Building relative path to package {0} from web_root {1}:'.format(full_path, self.web_root))
+        relative_path = os.path.relpath(full_path, self.web_root)
+        logger.debug('Relative path is: {0}'.format(relative_path))
 
-            # If there are debian versions, test those.
-            new_deb_ver = new_version[new_upstr_end + 1:] if new_upstr_end > 0 else '0'
-            old_deb_ver = old_version[old_upstr_end + 1:] if old_upstr_end > 0 else '0'
-            logger.debug("Upstream versions are equal.  Checking debian version string.")
+        # if self.web_root.endswith('/'):
+        #    relative_path = full_path[len(self.web_root):]
+        # else:
+        #    relative_path = full_path[len(self.web_root) + 1:]
 
-            out = self.debian_version_compare(new_deb_ver, old_deb_ver)
-            logger.debug("Result of debian_compare: %s is the higher version.", out)
+        # update the package object with the new filename, and then update the dictionary with the new
+        # package.
+        package['Filename'] = relative_path
+        local_pkg_index[package['Package']] = package
 
-            if out == new_deb_ver:
-                updated_list.append(package)
-                logger.debug("New version is higher; replace newest and check next package.")
-                if pkg_name == 'libcurl3-gnutls':
-                    print('New version debian section is higher; the new package object has been added to updated_list.')
-                continue
+    def compare_pkg_versions(self, new_records, old_pkg_cont):
+        """
+        Walks a stream of package records from a newer Packages file together with the contents of old_pkg_cont, both
+        in package name order (see merge_diff_pkg_records.)  Every package record in new_records that has a newer
+        version string than what is in old_pkg_cont (or that does not exist in old_pkg_cont) is added to an
+        updated_pkg list; every other record is dropped as soon as it has been compared, so the newer index is never
+        held in memory as a whole.
+        :param new_records: Iterable of the package records of a newer Packages file in package name order, such as
+        the stream iter_mapped_pkg_index returns.  A dictionary of package names to records is accepted as well.
+        :param old_pkg_cont:  The contents of an older Packages file; must be dictionary with package names as keys
+        and the package data (also a dictionary) as the value.
+        :return: A list object of packages from new_records whose version is newer than (or for which no equivalent
+        package exists in) the old_pkg_cont.
+        """
+
+        if isinstance(new_records, dict):
+            new_records = (new_records[name] for name in sorted(new_records))
+
+        logger.debug('Old packages list has {0} packages in it.'.format(len(old_pkg_cont)))
+
+        updated_list = []
+        counts = {'added': 0, 'upgraded': 0, 'removed': 0, 'unchanged': 0}
+        old_records = (old_pkg_cont[name] for name in sorted(old_pkg_cont))
+        for status, new_record, old_record in merge_diff_pkg_records(new_records, old_records):
+            counts[status] += 1
+            if status == 'added' or status == 'upgraded':
+                updated_list.append(new_record)
+
+        logger.debug('Index diff: {0[added]} added, {0[upgraded]} upgraded, {0[removed]} removed, '
+                     '{0[unchanged]} unchanged.'.format(counts))
 
         return updated_list
 
@@ -1203,96 +1831,19 @@ class DebianPkgManager:
         Compares the string/digit/string/digit... groupings of versiona and versionb.  If versiona lexically or
         numerically is greater than versionb, then the function returns versiona.  If versionb is lexically or
         numerically greater than versiona, then the function returns versionb.  If both strings are exactly equal,
-        the function returns None.
+        the function returns None.  Ordering follows dpkg, including ~ sorting before the end of the string.
         :param versiona: The first version string to compare according to the debian rules.
         :param versionb: The second version string to compare against the first according to debian rules.
         """
 
-        # Debian assumes an alternating pattern of <string><digit><string><digit>... in its versioning scheme.
-
-        # Start assuming that versiona is less than or equal to versionb.
-        larger = False
-
-        # Building a regular expression to pull out the alternating character types is probably doable, but it will
-        # be faster to just iterate the strings for realz.
-        a_index = 0
-        b_index = 0
-
-        logger.debug("Comparing versiona %s against versionb %s", versiona, versionb)
-        while a_index < len(versiona) and b_index < len(versionb):
-            logger.debug("a_index: %d", a_index)
-            logger.debug("b_index: %d", b_index)
-            # Start of the text substring (the next character following the end of the digit sequence.)
-            a_start = a_index
-            b_start = b_index
-            logger.debug("a_start: %d", a_start)
-            logger.debug("b_start: %d", b_start)
-
-            while a_index < len(versiona) and not versiona[a_index].isdigit():
-                logger.debug("Character %s in versiona is not a digit.", versiona[a_index])
-                a_index += 1
-            while b_index < len(versionb) and not versionb[b_index].isdigit():
-                logger.debug("Character %s in versionb is not a digit.", versionb[b_index])
-                b_index += 1
-
-            logger.debug("Non-digit segment for versiona computed, a_index now %d", a_index)
-            logger.debug("Non-digit segment for versionb computed, b_index now %d", b_index)
-
-            a_str = versiona[a_start:a_index] if a_index <= len(versiona) else ''
-            b_str = versionb[b_start:b_index] if b_index <= len(versionb) else ''
-
-            logger.debug("Non-digit segment for versiona is string '%s'", a_str)
-            logger.debug("Non-digit segment for versionb is string '%s'", b_str)
-
-            if a_str < b_str:
-                logger.debug("String comparison shows that a_str is smaller than b_str; return versionb.")
-                return versionb
-            elif b_str < a_str:
-                logger.debug("String comparison shows that b_str is smaller than a_str; return versiona.")
-                return versiona
-
-            # Start of the digit substring (the next character following the end of the numerical sequence.)
-            a_start = a_index
-            b_start = b_index
-
-            logger.debug("String segments are equal.  Compare subsequent digit sequence.")
-            logger.debug("a_start: %d", a_start)
-            logger.debug("b_start: %d", b_start)
-
-            while a_index < len(versiona) and versiona[a_index].isdigit():
-                logger.debug("Character %s in versiona is a digit.", versiona[a_index])
-                a_index += 1
-            while b_index < len(versionb) and versionb[b_index].isdigit():
-                logger.debug("Character %s in versionb is a digit.", versionb[b_index])
-                b_index += 1
-
-            a_int = int(versiona[a_start:a_index]) if len(versiona) >= a_index > a_start else 0
-            b_int = int(versionb[b_start:b_index]) if len(versionb) >= b_index > b_start else 0
-
-            logger.debug("Integer segment for versiona is %d", a_int)
-            logger.debug("Integer segment for versionb is %d", b_int)
-
-            if a_int < b_int:
-                logger.debug("Integer segment for versiona is smaller than versionb, return versionb.")
-                return versionb
-            elif b_int < a_int:
-                logger.debug("Integer segment for versionb is smaller than versiona, return versiona.")
-                return versiona
-
-        logger.debug("Exhausted one of versiona or versionb; length check is last.  Shorter string loses,"
-                     "longer string is returned.")
-        # Match the behavior of python lexical compare.  Note that this will probably cause issues if a package
-        # version increments out of alpha, e.g goes from 9.50a to 9.50, as now the new value is shorter and therefore
-        # lexicographically smaller....
-        if a_index < len(versiona):
-            logger.debug("a_index is less than length of versiona, so versiona is longer.  Returning versiona.")
+        a_key = debian_version_part_key(versiona)
+        b_key = debian_version_part_key(versionb)
+
+        if a_key > b_key:
             return versiona
-        if b_index < len(versionb):
-            logger.debug("b_index is less than length of versionb, so versionb is longer.  Returning versionb.")
+        elif b_key > a_key:
             return versionb
 
-        logger.debug("Both strings are identical.  Returning None.")
-
         return None
 
     def read_pkg_index_file(self, path):
@@ -1305,7 +1856,26 @@ class DebianPkgManager:
                  None if the path could not be opened or the contents wholly unreadable as a Package index file.
         """
 
+        records = self.iter_pkg_index_file(path)
+        if records is None:
+            return None
+
         retval = {}
+        for record in records:
+            retval[record['Package']] = record
+
+        logger.debug('{0} package records were read in from file {1}.'.format(len(retval), path))
+
+        return retval
+
+    def open_pkg_index_file(self, path):
+        """
+        Opens a Packages index file for reading, selecting the decompressor from the file name.  Cached Packages
+        files carry the cache name suffix after the extension, so that is trimmed off before testing the type.
+        :param path: The path to the plain, gzip, bzip2 or xz Packages file.
+        :return: A readable stream of decompressed Packages data.
+                 None if the path could not be opened or is not a Packages file of a recognized type.
+        """
 
         # The Packages path that is passed in may be a cached file, which means it has additional name data
         # appended to it.  We remove that data here to test the actual file type.
@@ -1340,137 +1910,157 @@ class DebianPkgManager:
                 stream = bz2.BZ2File(path, 'r')
             elif filename.endswith('.gz'):
                 stream = gzip.GzipFile(path, 'r')
+            elif filename.endswith('.xz') and lzma is not None:
+                stream = lzma.LZMAFile(path, 'r')
             else:
                 # Unknown file extension.  Return with error.
                 logger.error('The file features a file with an unknown extension.'.format(filename))
-                raise IOError('Path {0} does not point to a bz2, gzip or uncompressed Packages file.'.format(path))
+                raise IOError('Path {0} does not point to an xz, bz2, gzip or uncompressed Packages '
+                              'file.'.format(path))
         except IOError:
             logger.error('The path {0} does not point to a valid file.  '
                          'Cannot read contents of Packages file.'.format(path))
             return None
 
-        record = self.read_package_record(stream)
+        return stream
 
-        while record != {}:
-            pkg_name = record['Package']
-            logger.debug('Package {0} has been read in from file {1}.'.format(pkg_name, path))
-            retval[pkg_name] = record
+    def iter_pkg_index_file(self, path):
+        """
+        Streaming counterpart to read_pkg_index_file.  Opens the Packages file at path and returns a generator that
+        yields one package record at a time, so that callers can filter the index without ever holding all of it.
+        Upstream indexes do not go through here during a sync: their cache is uncompressed, so iter_mapped_pkg_index
+        can skip even the parsing of the stanzas that are not whitelisted, and streams the rest to the diff itself.
+        :param path: The path to the plain, gzip, bzip2 or xz Packages file.
+        :return: A generator of package records.
+                 None if the path could not be opened as a Packages file.
+        """
 
-            record = self.read_package_record(stream)
+        stream = self.open_pkg_index_file(path)
+        if stream is None:
+            return None
 
-        # Close the read stream when done.
-        stream.close()
+        return self.iter_package_records(stream, close=True)
 
-        logger.debug('{0} package records were read in from file {1}.'.format(len(retval), path))
+    def iter_package_records(self, iostream, close=False):
+        """
+        Generator that reads package records out of iostream with read_package_record until the stream is exhausted.
+        :param iostream: data stream object holding Package record set.
+        :param close: If True, the stream is closed once the last record has been read (or the generator is
+        discarded part way through.)
+        :return: Yields one package record dictionary per stanza.
+        """
 
-        return retval
+        try:
+            record = self.read_package_record(iostream)
+            while record:
+                yield record
+                record = self.read_package_record(iostream)
+        finally:
+            if close:
+                iostream.close()
+
+    def read_mapped_pkg_index(self, path, component, category, mirrored=()):
+        """
+        Reads the whitelisted packages out of an uncompressed (cached) Packages file without parsing the rest of it
+        (see iter_mapped_pkg_index.)
+        :param path: The path to the uncompressed Packages file.
+        :param component: The component that the Packages file belongs to.
+        :param category: The category to apply the whitelist for.
+        :param mirrored: Container supporting 'in' of the package names already in the local repository.
+        :return: Dictionary of whitelisted package records, keyed by package name.
+                 None if the path could not be opened or mapped.
+        """
 
-    def apply_whitelist(self, pkg_dict, component, category):
-        """
-        Checks the packages stored within the package dictionary and removes them if they are not held in the
-        whitelist, or if they are not a dependency of a whitelisted package and override_whitelist is enabled.
-        :param pkg_dict: The dictionary containing the package records.  Should be in form of {pkg_name: {record}}
-        :param component: The component that the pkg_dict belongs to.
-        :param category: The category of the package dictionary.
-        :return: Dictionary: a cleaned up copy of the pkg_dict dictionary if the whitelist can be applied
-                 None: returned if the package list is malformed or there are problems with the whitelist that
-                 prevent the whitelist cleanup from being applied.
-        """
-
-        logger.debug('Applying the whitelist to reduce the package count.  '
-                     'Incoming package count: {0}'.format(len(pkg_dict)))
-
-        logger.debug('Looking at whitelist for component {0}, category {1}'.format(component, category))
-        logger.debug('Whitelisted packages: {0}'.format(self.whitelist[component]))
-
-        if len(pkg_dict) > 0:
-            logger.debug('Some entries from pkg_dict:')
-
-        # Build up the list of dependencies of whitelisted package names, if needed.
-        override_list = []
-        if self.whitelist_override:
-            for name in self.whitelist[component]:
-                logger.debug('Looking at package {0} in the whitelist for component {1}.'.format(name, component))
-                logger.debug('Category list associated with package: {0}'.format(self.whitelist[component][name]))
-
-                # if the category is in the category list for component and name, then this package is whitelisted.
-                # if further the package name is in the pkg_dict, then we need to get this package's dependencies.
-                logger.debug('Category in self.whitelist[component][name]? '
-                             '{0}'.format(category in self.whitelist[component][name]))
-                logger.debug('Package name in pkg_dict? {0}'.format(name in pkg_dict))
-
-                if category in self.whitelist[component][name] and name in pkg_dict:
-                    logger.debug('Category {0} is in whitelist for package {1}.'.format(category, name))
-                    # Add the dependencies to the override list.
-                    dependencies = self.format_dependance_strings(pkg_dict[name])
-                    # We need to also check the dependencies of the dependencies recursively...
-                    while len(dependencies) > 0:
-                        pkg_name = dependencies.pop(0)
-
-                        try:
-                            pkg = pkg_dict[pkg_name]
-                        except KeyError:
-                            logger.error('Dependency {0} of package {1} is not present in the package dictionary.'
-                                         'We cannot add the dependency to the override list.'.format(pkg_name, name))
-                            continue
+        records = self.iter_mapped_pkg_index(path, component, category, mirrored)
+        if records is None:
+            return None
 
-                        # Make sure the dependent package is not already in the whitelist.
-                        if pkg_name not in self.whitelist[component]:
-                            logger.debug('Dependency {0} is not in the whitelist.  Adding to override, if not'
-                                         'already present.'.format(pkg_name))
-                            if pkg_name not in override_list:
-                                logger.debug('Dependency {0} not in override list.'.format(pkg_name))
-                                override_list.append(pkg_name)
-                        else:
-                            logger.debug('Dependency {0} has already been whitelisted.'.format(pkg_name))
-                            continue
+        return dict((record['Package'], record) for record in records)
 
-                        # Don't blanket extend dependencies; confirm that nothing we're adding already exists.
-                        logger.debug("Expanding existing dependency list with {0}'s dependencies.".format(pkg_name))
-                        temp = self.format_dependance_strings(pkg)
-                        logger.debug("Retrieved dependencies are: {0}".format(temp))
-                        for dependency in self.format_dependance_strings(pkg):
-                            logger.debug('Checking if package {0} already exists in lists.'.format(dependency))
-                            if dependency in override_list:
-                                logger.debug('{0} exists in override list.'.format(dependency))
-                                continue
-                            if dependency in dependencies:
-                                logger.debug('{0} exists in dependency list.'.format(dependency))
-                                continue
-
-                            # otherwise add it to the unchecked dependency list.
-                            logger.debug('Dependency {0} not in dependency or override lists; '
-                                         'adding here.'.format(dependency))
-                            dependencies.append(dependency)
-
-        logger.debug('{0} packages identified in the override_list.'.format(len(override_list)))
-        logger.debug('Checking override and whitelist against {0} records in pkg_dict.'.format(len(pkg_dict)))
-        # We've built the override_list.  Now to actually clear unwanted packages from pkg_dict.
-        for pkg_name in pkg_dict.keys():
-            # if the package name is in the whitelist under component and the category list contains the category
-            # name, then we leave the pkg_dict entry alone.
-            if pkg_name in self.whitelist[component] and category in self.whitelist[component][pkg_name]:
-                logger.debug('{0} is whitelisted for this component and category.'.format(pkg_name))
-                continue
-            # Or if the package name has been added to the override list, leave it alone.
-            elif pkg_name in override_list:
-                logger.debug('{0} is in the override list - leaving in.'.format(pkg_name))
-                continue
+    def iter_mapped_pkg_index(self, path, component, category, mirrored=()):
+        """
+        Streams the whitelisted packages out of an uncompressed (cached) Packages file without parsing the rest of it.
+        The file is memory-mapped and indexed by package name in a single scan; only the stanzas that the whitelist
+        closure touches are ever parsed into records, and the records are yielded in package name order without being
+        kept, so the caller decides which of them stay in memory.
+        :param path: The path to the uncompressed Packages file.
+        :param component: The component that the Packages file belongs to.
+        :param category: The category to apply the whitelist for.
+        :param mirrored: Container supporting 'in' of the package names already in the local repository.
+        :return: A generator of whitelisted package records, in package name order.  The file stays mapped until the
+        generator is exhausted or discarded.
+                 None if the path could not be opened or mapped.
+        """
+
+        try:
+            pkg_index = MappedPackageIndex(path, self.read_package_record)
+        except (IOError, OSError, EnvironmentError) as err:
+            logger.error('Unable to map Packages file {0}: {1}'.format(path, err))
+            return None
+
+        try:
+            keep = self.whitelist_closure(pkg_index, component, category, pkg_index.provides, mirrored)
+        except Exception:
+            pkg_index.close()
+            raise
+
+        logger.debug('{0} of {1} package records in file {2} are whitelisted.'.format(len(keep), len(pkg_index),
+                                                                                     path))
+
+        def records():
+            try:
+                for record in pkg_index.iter_records(sorted(keep)):
+                    yield record
+            finally:
+                pkg_index.close()
+
+        return records()
+
+    def whitelist_closure(self, pkg_index, component, category, provides=None, mirrored=()):
+        """
+        Computes the set of package names that survive the whitelist: every package whitelisted for the category
+        and present in the index, plus - when override_whitelist is enabled - the packages chosen to satisfy the
+        depends and recommends of those packages, recursively (see DependencyGraph.)  Records are only looked at for
+        packages the closure actually reaches.
+        :param pkg_index: Mapping of every package name in the index to its package record.
+        :param component: The component whose whitelist is applied.
+        :param category: The category to apply the whitelist for.
+        :param provides: Dictionary mapping each package name in the index with a Provides field to its value.  If
+        None, it is collected from the records in pkg_index.
+        :param mirrored: Container supporting 'in' of the package names already in the local repository; these are
+        preferred when choosing between alternatives.
+        :return: A set of package names to keep.
+        """
 
-            # In the event that the package name is not in either the whitelist or the override list, we remove it.
-            logger.debug('{0} is not in whitelist over override - ignoring.'.format(pkg_name))
-            pkg_dict.pop(pkg_name)
+        matcher = self.whitelist_matcher(component, category)
+        if matcher.has_patterns():
+            # Patterns have to be tried against every name in the index - in one pass.
+            keep = set(name for name in pkg_index if matcher.match(name))
+        else:
+            keep = set(name for name in matcher.names if name in pkg_index)
+
+        if not self.whitelist_override:
+            return keep
+
+        if provides is None:
+            provides = dict((name, record['Provides']) for name, record in pkg_index.iteritems()
+                            if 'Provides' in record)
+
+        reached, missing = DependencyGraph(pkg_index, provides, mirrored).closure(keep)
+        for relation, name in missing.iteritems():
+            logger.error('Dependency {0} of package {1} cannot be satisfied from the package dictionary.  '
+                         'We cannot add the dependency to the override list.'.format(relation, name))
 
-        logger.debug('{0} packages left after trimming out non-whitelisted items.'.format(len(pkg_dict)))
-        return pkg_dict
+        logger.debug('{0} packages identified in the override_list.'.format(len(reached) - len(keep)))
+
+        return reached
 
     def read_cached_pkg_index(self, component):
         """
-        Read the Package file for each component and category (for binary, include all architectures).  For each
-        package, check if it is in the whitelist and, if so, add it to a whitelisted packages list.  If it is not,
-        add it to a blacklisted package list. If override_whitelist is enabled, each package in the depends and
-        recommends fields needs to be examined and either added to the whitelist, or the package record pulled off the
-        blacklist (and that record's depends/recommends values processed and added to the search list.)
+        Read the Package file for each component and category (for binary, include all architectures).  Every package
+        that is whitelisted for the binary category is approved; if override_whitelist is enabled, the packages chosen
+        to satisfy the depends and recommends fields of approved packages are approved as well, recursively.  Only the
+        approved stanzas of each cached file are parsed (see read_mapped_pkg_index.)
         :param component: Component whose packages we're attempting to update.
         :return: Dictionary: A dictionary with one entry for each architecture, each of whose values is a dictionary of
         approved (whitelisted) packages for that architecture.
@@ -1482,112 +2072,52 @@ class DebianPkgManager:
 
         retval = {}
         for item in category:
-            approved_pkgs = {}
-            blacklisted_pkgs = {}
-
             pkg_cachefile = self.generate_cache_filename('Packages', component, item)
             pkg_cachefile = os.path.join(self.cache_dir, pkg_cachefile)
-            try:
-                fd = open(pkg_cachefile, 'r')
-            except IOError:
+
+            approved_pkgs = self.read_mapped_pkg_index(pkg_cachefile, component, 'binary',
+                                                       self.read_local_pkg_index(component, item))
+            if approved_pkgs is None:
                 logger.error('An error occurred while trying to open the cached Package file {0}.  Returning'
                              'unsuccessful attempt.'.format(pkg_cachefile))
                 return None
 
-            # pre-read in a record.
-            record = self.read_package_record(fd)
-            while len(record) > 0:
-                # Check the record against the whitelist and confirm that it's whitelisted for binary categories.
-                name = record['Package']
-                if name in self.whitelist[component] and 'binary' in self.whitelist[component][name]:
-                    approved_pkgs[name] = record
-                    # Handle whitelist override.
-                    if self.whitelist_override:
-                        # Depends and Recommends are not required fields.  We want them combined into one string
-                        # if they exist.
-                        pkg_list = self.format_dependance_strings(record)
-                        while len(pkg_list) > 0:
-                            # If package is already in whitelist, we don't care.  We can ignore that condition.
-                            if pkg_list[0] in self.whitelist[component] and \
-                              'binary' in self.whitelist[component][pkg_list[0]]:
-                                pkg_list.pop(0)
-                            # if the package is in the blacklist, move it to whitelist and extend the pkg_list with
-                            # its dependencies.
-                            elif pkg_list[0] in blacklisted_pkgs:
-                                pkg_record = blacklisted_pkgs.pop(pkg_list[0])
-                                approved_pkgs[pkg_list[0]] = pkg_record
-                                pkg_list.extend(self.format_dependance_strings(pkg_record))
-                                pkg_list.pop(0)
-                            # If the package not in the whitelist or blacklist, it hasn't been read yet and can simply
-                            # be added to the whitelist.
-                            else:
-                                self.whitelist[component][pkg_list[0]] = ['binary']
-                else:
-                    blacklisted_pkgs[name] = record
-
-                # Read the next record.
-                record = self.read_package_record(fd)
-
             # Add the approved packages dictionary to the return value under the binary-<component> key.
             retval[item] = approved_pkgs
 
-            # Close the package file.
-            fd.close()
-
         return retval
 
-    def format_dependance_strings(self, pkg_record):
-        """
-        Given a package record, extract the depends and recommends keys and turn the values into a properly
-        formatted package list.
-        :param pkg_record: The package record whose depends and recommends fields we want to use.
-        :return: A list of package names that are present in the package record.
-        """
-
-        # The string that will store the temporare package lists.
-        extra_pkgs = ''
-
-        # Neither Depends nor Recommends are required fields in a Package record.
-        if 'Depends' in pkg_record:
-            extra_pkgs = pkg_record['Depends'].replace('|', ',') + ','
-        if 'Recommends' in pkg_record:
-            extra_pkgs += pkg_record['Recommends'].replace('|', ',')
-        else:
-            if extra_pkgs.endswith(','):
-                extra_pkgs = extra_pkgs.rstrip(',')
-
-        # Depends and Recommends can specify versions.  We don't care about them.
-        start = extra_pkgs.find('(')
-        while start >= 0:
-            end = extra_pkgs.find(')', start)
-            extra_pkgs = extra_pkgs[:start] + extra_pkgs[end + 1:]
-            start = extra_pkgs.find('(')
-
-        logger.debug('Completed dependency and recommends package string breakdown.')
-
-        # and finally, split on comma's, removing extra spaces and returning the result.
-        return [x.strip() for x in extra_pkgs.split(',') if x != '']
-
     def read_package_record(self, iostream):
         """
-        Reads a single package record from a stream object.
+        Reads a single package record from a stream object.  Blank lines ahead of the record are skipped.
         :param iostream: data stream object holding Package record set.
-        :return: A dictionary object containing the key:value pairs comprising a Package record.
+        :return: A PackageRecord object containing the key:value pairs comprising a Package record.  The record is
+        empty (len() of 0) when the stream holds no further records.
         """
 
-        record = {}
+        record = PackageRecord()
         key = ''
         value = ''
+        # The raw stanza, and the offsets of the Filename field and of the field being read within it.
+        raw_lines = []
+        raw_size = 0
+        filename_span = None
+        field_start = 0
         for line in iostream:
             if line == '\n':
-                record[key] = value.strip()
+                if not key:
+                    continue
                 break
             else:
+                if not line.endswith('\n'):
+                    line += '\n'
                 if line.startswith(' '):
                     value += line.strip()
                 else:
                     if key:
-                        record[key] = value.strip()
+                        record.add_field(key, value.strip())
+                        if key == 'Filename':
+                            filename_span = (field_start, raw_size)
 
                     pair = line.split(':', 1)
                     if len(pair) != 2:
@@ -1596,6 +2126,15 @@ class DebianPkgManager:
                     else:
                         value = pair[1].strip()
                     key = pair[0].strip()
+                    field_start = raw_size
+                raw_lines.append(line)
+                raw_size += len(line)
+
+        if key:
+            record.add_field(key, value.strip())
+            if key == 'Filename':
+                filename_span = (field_start, raw_size)
+            record.set_stanza(''.join(raw_lines), filename_span)
 
         return record
 
@@ -1698,99 +2237,1967 @@ class DebianPkgManager:
         return index_file + unique_suffix
 
 
-def download_file(uri, path, cache_ts=None):
+class LRUCache:
     """
-    Given a uri and path including file, download_file will attempt to download that file.  If cache_date is
-    set to a datetime object, download_file will first attempt to confirm that the remote file is newer than
-    the date, so that callers can make use of cached local copies of the file.
-    :param uri: The url string to the file we are attempting to download.  Must contain at least the fqdn, may
-    contain some of the remote host path to the file.
-    :param path: The path on the remote webserver including the filename that we want to download.  The path
-    should be relative to the end of the domain and path in the uri.
-    :param cache_ts: A timestamp to compare the remote file time to.  If None, then the remote file will be
-    downloaded regardless of its last update time; if present (must be a datetime object) then the modified date
-    and time of the remote file will be compared against the datetime value, and only downloaded if it is newer.
+    Bounded mapping that discards the least recently used entries once it is full.  Rather than tracking an exact
+    recency order (collections.OrderedDict is pure python, and slower than the computations it would be caching) the
+    cache keeps two generations of plain dictionaries: hits in the old generation are promoted to the new one, and
+    when the new generation fills up the old one - everything not used since the last turnover - is dropped.
     """
-    global logger
 
-    logger.debug("Attempting to download file %s from uri %s.", path, uri)
+    def __init__(self, size):
+        """
+        :param size: The maximum number of entries held.
+        """
 
-    # httplib wants the domain and the path to be completely separate, and not to include the http protocol portion.
-    # Test the uri here, split it apart if need be, and then join any path bits to the path bit that was passed to us.
-    # Check for the '://' that indicates the presence of the protocol specifier in a url.
-    if uri.find('://') >= 0:
-        logger.debug('uri contains protocol specifier - removing.')
-        partial_split = uri.split('://')
-        protocol = partial_split[0]
-        uri = partial_split[1]
+        self.size = size
+        self._new = {}
+        self._old = {}
 
-    # uri either had no protocol or has been overwritten such that no protocol component exists.  Check for path
-    # separator.
-    if uri.find('/') >= 0:
-        logger.debug('uri contains partial path - splitting apart.')
-        # split ONE time, at the first separator.
-        partial_split = uri.split('/', 1)
-        domain = partial_split[0]
-        uri_path = partial_split[1]
-    else:
-        domain = uri
-        uri_path = ''
+    def get(self, key, default=None):
+        try:
+            return self._new[key]
+        except KeyError:
+            pass
 
-    # uri_path may be '' or it may be non-empty string.  It will not start with a / in either case.  Join it to the
-    # value of the path that was passed to us, if it is non-empty.
-    if uri_path.endswith('/') and path.startswith('/'):
-        full_path = uri_path[:-1] + path
-    elif not uri_path.endswith('/') and not path.startswith('/'):
-        full_path = uri_path + '/' + path
-    else:
-        full_path = uri_path + path
+        try:
+            value = self._old.pop(key)
+        except KeyError:
+            return default
 
-    if not full_path.startswith('/'):
-        full_path = '/' + full_path
+        self[key] = value
+        return value
 
-    logger.debug("Opening http connection to remote server.")
-    if cache_ts is not None and isinstance(cache_ts, datetime.datetime):
-        # create a separate connection here - httplib is supposedly finicky about
-        # reusing connections.
-        logger.debug("Getting state information about remote file.")
-        conn = httplib.HTTPConnection(domain)
-        conn.request("HEAD", full_path)
-        reply = conn.getresponse()
-        # httplib does not like when reply is not read.  We don't need it, though, since this is just a header check.
-        dump = reply.read()
-        status = reply.status
-        # done with the connection here
-        conn.close()
+    def __setitem__(self, key, value):
+        if len(self._new) >= self.size // 2:
+            self._old = self._new
+            self._new = {}
+        self._new[key] = value
 
-        if status != 200:
-            logger.error("URL %s, path %s were not found by httplib.", domain, full_path)
-            raise httplib.InvalidURL, domain + full_path + ' was not found.'
+    def __len__(self):
+        return len(self._new) + len(self._old)
 
-        datestring = reply.getheader('Last-Modified')
-        url_ts = datetime.datetime.strptime(datestring, '%a, %d %b %Y %H:%M:%S %Z')
 
-        # if the url's date and time is older or equal to the local cache, just
-        # return None and perform no download.
-        if url_ts <= cache_ts:
-            logger.debug("provided timestamp is at least as new as the remote host, if not newer.")
-            return None
+# Compiled version keys (see debian_version_key), keyed by version string.
+version_key_cache = LRUCache(262144)
 
-    # if the cache_ts is not set, or else it is older than the url_ts, go ahead
-    # and download.
+# The Date field of a Release file.
+release_date_pattern = re.compile(r'^Date:(.*)$', re.MULTILINE)
 
-    logger.debug("Downloading file...")
-    conn = httplib.HTTPConnection(domain)
-    conn.request("GET", full_path)
-    reply = conn.getresponse()
-    content_type = reply.getheader("Content-Type")
-    if reply.status != 200:
-        logger.debug("URL %s, path %s were not found by httplib.", domain, full_path)
-        raise httplib.InvalidURL, domain + full_path + ' was not found.'
+# Parsed relation fields (see parse_relations), keyed by the field value.
+relations_cache = LRUCache(131072)
+# A single relation: a package name, an optional :arch qualifier (ignored) and an optional version constraint.
+relation_pattern = re.compile(r'\s*([^\s(\[<:,|]+)(?::[^\s(\[<,|]+)?\s*(?:\(\s*(<<|<=|>=|>>|=|<|>)\s*([^)\s]+)\s*\))?')
+# The comparison results that satisfy each relation operator ('<' and '>' are the obsolete spellings of <= and >=.)
+relation_operators = {'<<': (-1,), '<=': (-1, 0), '<': (-1, 0), '=': (0,), '>=': (0, 1), '>': (0, 1), '>>': (1,)}
 
-    file_data = reply.read()
+# An ed command line as emitted by diff --ed: a line or line range followed by a, c or d.
+ed_command_pattern = re.compile(r'^(\d+)(?:,(\d+))?([acd])$')
 
-    logger.debug("File downloaded, returning acquired data to caller.")
-    return file_data
+# Splits a version string into alternating non-digit/digit runs, and the dpkg sort weight of each character.
+version_run_pattern = re.compile(r'([^0-9]*)([0-9]*)')
+version_char_weights = dict((chr(i), -1 if chr(i) == '~' else i if chr(i).isalpha() else i + 256) for i in range(256))
+
+
+def debian_version_part_key(part):
+    """
+    Compiles an upstream version or debian revision string into a tuple that sorts the way dpkg orders such strings.
+    The string is broken into alternating non-digit and digit runs.  Each non-digit run becomes the weights of its
+    characters (~ below everything, letters below all other characters) followed by a 0 for the end of the run,
+    and each digit run becomes its integer value.  A trailing 0 stands in for the empty run that dpkg compares a
+    shorter string's end against.
+    :param part: The upstream version or debian revision string.
+    :return: A tuple of integers.
+    """
+
+    key = []
+    for text, digits in version_run_pattern.findall(part):
+        # findall ends on an empty match; it only matters when the whole string is empty.
+        if not text and not digits and key:
+            break
+        key.extend(map(version_char_weights.__getitem__, text))
+        key.append(0)
+        key.append(int(digits) if digits else 0)
+    key.append(0)
+
+    return tuple(key)
+
+
+def debian_version_key(version):
+    """
+    Compiles a full debian version string ([epoch:]upstream_version[-debian_revision]) into a sort key, so that
+    comparing two versions is a single tuple comparison.  Keys are kept in a bounded LRU cache keyed by the version
+    string, as the same versions are compared again and again across indexes and architectures.
+    :param version: The version string.
+    :return: A tuple of (epoch, upstream key, revision key.)
+    """
+
+    key = version_key_cache.get(version)
+    if key is None:
+        colon = version.find(':')
+        try:
+            epoch = int(version[:colon]) if colon >= 0 else 0
+        except ValueError:
+            logger.warn('Version {0} has a non-numeric epoch.  Treating it as 0.'.format(version))
+            epoch = 0
+
+        remainder = version[colon + 1:]
+        # The revision starts after the last hyphen; upstream versions may contain hyphens of their own.
+        hyphen = remainder.rfind('-')
+        if hyphen >= 0:
+            key = (epoch, debian_version_part_key(remainder[:hyphen]), debian_version_part_key(remainder[hyphen + 1:]))
+        else:
+            key = (epoch, debian_version_part_key(remainder), debian_version_part_key(''))
+
+        version_key_cache[version] = key
+
+    return key
+
+
+def parse_relations(field):
+    """
+    Parses a Depends, Recommends or Provides style field into its relations.  Architecture qualifiers (:any) are
+    dropped, as are architecture restrictions ([...]) and build profiles (<...>), which only apply to source packages.
+    Results are kept in a bounded LRU cache keyed by the field value.
+    :param field: The field value, e.g. 'libc6 (>= 2.14), debconf | debconf-2.0'.
+    :return: A tuple with one entry per comma separated group, each a tuple of its | separated alternatives as
+    (name, operator, version) tuples.  Operator and version are None for an unversioned relation.
+    """
+
+    groups = relations_cache.get(field)
+    if groups is None:
+        groups = []
+        for group in field.split(','):
+            alternatives = []
+            for alternative in group.split('|'):
+                match = relation_pattern.match(alternative)
+                if match:
+                    alternatives.append(match.groups())
+            if alternatives:
+                groups.append(tuple(alternatives))
+        groups = tuple(groups)
+        relations_cache[field] = groups
+
+    return groups
+
+
+def version_satisfies(version, operator, required):
+    """
+    :param version: The version string available, or None if there is no version.
+    :param operator: The relation operator, or None for an unversioned relation.
+    :param required: The version string the relation names.
+    :return: True if version satisfies the relation.
+    """
+
+    if operator is None:
+        return True
+    if version is None:
+        return False
+
+    return cmp(debian_version_key(version), debian_version_key(required)) in relation_operators[operator]
+
+
+class DependencyGraph:
+    """
+    Dependency resolver over a package index, for walking whitelist closures.  The Depends and Recommends relations of
+    a package are parsed the first time the package is visited, and each group of alternatives is resolved to a
+    single package: the alternatives, real packages or providers of a virtual package, that satisfy the relation's
+    version constraint are considered in the order they are listed, preferring one the walk has already reached,
+    then one that is already mirrored, then the first.
+    """
+
+    def __init__(self, pkg_index, provides, mirrored=()):
+        """
+        :param pkg_index: Mapping of every package name in the index to its package record (or to any mapping holding
+        its Version, Depends and Recommends fields.)
+        :param provides: Dictionary mapping the name of every package in the index that has a Provides field to the
+        field's value.
+        :param mirrored: Container supporting 'in' of the package names already in the local repository.
+        """
+
+        self.pkg_index = pkg_index
+        self.mirrored = mirrored
+        self._relations = {}
+        self._candidates = {}
+
+        # Virtual package name -> [(providing package, provided version or None)].
+        self._providers = {}
+        for name, field in provides.iteritems():
+            for group in parse_relations(field):
+                virtual, operator, version = group[0]
+                self._providers.setdefault(virtual, []).append((name, version if operator == '=' else None))
+
+    def relations(self, name):
+        """
+        :param name: A package name in the index.
+        :return: The parsed Depends and Recommends relations of the package (see parse_relations.)
+        """
+
+        try:
+            return self._relations[name]
+        except KeyError:
+            pass
+
+        record = self.pkg_index[name]
+        depends = record.get('Depends')
+        recommends = record.get('Recommends')
+        relations = parse_relations(depends) if depends is not None else ()
+        if recommends is not None:
+            relations += parse_relations(recommends)
+        self._relations[name] = relations
+
+        return relations
+
+    def candidates(self, group):
+        """
+        :param group: A tuple of alternative relations, as returned by parse_relations.
+        :return: A list of the package names in the index that satisfy the group, in order of preference.
+        """
+
+        try:
+            return self._candidates[group]
+        except KeyError:
+            pass
+
+        candidates = []
+        for name, operator, version in group:
+            # Only a versioned relation needs the candidate's record to be parsed.
+            if name in self.pkg_index and (operator is None or
+                                           version_satisfies(self.pkg_index[name].get('Version'), operator, version)):
+                candidates.append(name)
+            # A versioned relation is only satisfied by a provider that provides a version.
+            for provider, provided in self._providers.get(name, ()):
+                if operator is None or version_satisfies(provided, operator, version):
+                    candidates.append(provider)
+        self._candidates[group] = candidates
+
+        return candidates
+
+    def closure(self, roots):
+        """
+        Breadth first walk from roots, resolving every relation of every package reached to a single package.
+        :param roots: Iterable of package names in the index to start from.
+        :return: A tuple of (set of every name reached, roots included; dictionary of the relations that could not be
+        satisfied, as text, each mapped to the name of a package that has it.)
+        """
+
+        reached = set(roots)
+        missing = {}
+        queue = collections.deque(reached)
+        while queue:
+            name = queue.popleft()
+            for group in self.relations(name):
+                candidates = self.candidates(group)
+                if not candidates:
+                    missing.setdefault(' | '.join(alternative[0] if alternative[1] is None else
+                                                  '{0} ({1} {2})'.format(*alternative) for alternative in group), name)
+                    continue
+
+                for candidate in candidates:
+                    if candidate in reached:
+                        break
+                else:
+                    for candidate in candidates:
+                        if candidate in self.mirrored:
+                            break
+                    else:
+                        candidate = candidates[0]
+                    reached.add(candidate)
+                    queue.append(candidate)
+
+        return reached, missing
+
+
+class WhitelistMatcher:
+    """
+    The entries of one component's whitelist that are enabled for a category, compiled for matching package names.
+    Entries are exact package names, globs (*, ? and [...]), or regular expressions written between slashes, which
+    must match the whole name.  Exact names are held in a set; globs of the form prefix* (the common case, e.g.
+    linux-image-*) in a table of prefixes keyed by length; and every other glob and regular expression is combined
+    into as few alternations as possible, so that each name costs one set lookup, one lookup per prefix length and
+    usually a single regular expression match.  An alternation holds at most max_groups capturing groups, the most a
+    pattern may have.  Expressions whose meaning depends on the rest of the pattern - backreferences, named groups,
+    conditionals and inline flags, which apply to the whole pattern - are compiled on their own instead.
+    """
+
+    glob_characters = re.compile(r'[*?\[]')
+    # Constructs that cannot safely share a pattern with other expressions.
+    context_dependent = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[iLmsux]+\)')
+    leading_flags = re.compile(r'^(?:\(\?[iLmsux]+\))+')
+    # The re module refuses patterns with more than 100 groups, counting the implicit group 0.
+    max_groups = 99
+
+    def __init__(self, entries, category):
+        """
+        :param entries: Dictionary of whitelist entries to their category lists, as held in DebianPkgManager.whitelist.
+        :param category: The category the entries must be enabled for.
+        """
+
+        self.names = set()
+        # Prefix length -> set of prefixes of that length.
+        self.prefixes = {}
+        # Expressions that can share an alternation, with their number of capturing groups.
+        expressions = []
+        # Expressions that have to be matched on their own, compiled.
+        separate_expressions = []
+
+        for entry, category_list in entries.iteritems():
+            if category not in category_list:
+                continue
+            if len(entry) > 1 and entry.startswith('/') and entry.endswith('/'):
+                expression = entry[1:-1]
+            elif WhitelistMatcher.glob_characters.search(entry) is None:
+                self.names.add(entry)
+                continue
+            elif entry.endswith('*') and WhitelistMatcher.glob_characters.search(entry[:-1]) is None:
+                self.prefixes.setdefault(len(entry) - 1, set()).add(entry[:-1])
+                continue
+            else:
+                expression = WhitelistMatcher.translate_glob(entry)
+
+            # Too many groups is reported through an AssertionError rather than re.error.
+            try:
+                groups = re.compile(expression).groups
+            except (re.error, AssertionError) as err:
+                logger.error('Whitelist entry {0} is not a valid regular expression ({1}).  Ignoring it.'.format(entry,
+                                                                                                               err))
+                continue
+
+            if WhitelistMatcher.context_dependent.search(expression) is None:
+                expressions.append((expression, groups))
+            else:
+                # Keep any leading inline flags at the front, where they belong.
+                flags = WhitelistMatcher.leading_flags.match(expression)
+                flags = flags.group(0) if flags else ''
+                separate_expressions.append(re.compile(flags + '(?:' + expression[len(flags):] + r')\Z'))
+
+        self.prefix_lengths = sorted(self.prefixes)
+
+        # Split the shareable expressions into alternations that each stay within the group limit.
+        self.expressions = []
+        chunk = []
+        chunk_groups = 0
+        for expression, groups in expressions:
+            if chunk and chunk_groups + groups > WhitelistMatcher.max_groups:
+                self.expressions.extend(WhitelistMatcher.combine_expressions(chunk))
+                chunk = []
+                chunk_groups = 0
+            chunk.append(expression)
+            chunk_groups += groups
+        if chunk:
+            self.expressions.extend(WhitelistMatcher.combine_expressions(chunk))
+        self.expressions.extend(separate_expressions)
+
+    @staticmethod
+    def combine_expressions(expressions):
+        """
+        :param expressions: Regular expressions (without anchors) that each compile on their own.
+        :return: A list of compiled patterns that between them match whole names matching any of the expressions;
+        a single alternation unless the expressions could not be compiled together.
+        """
+
+        try:
+            return [re.compile('(?:' + '|'.join('(?:' + expression + ')' for expression in expressions) + r')\Z')]
+        except (re.error, AssertionError) as err:
+            logger.debug('Unable to combine whitelist expressions ({0}); matching them one by one.'.format(err))
+            return [re.compile('(?:' + expression + r')\Z') for expression in expressions]
+
+    @staticmethod
+    def translate_glob(glob_pattern):
+        """
+        :param glob_pattern: A glob using *, ? and [...] (with ! or ^ for negation.)
+        :return: A regular expression (without anchors) that matches the same names.
+        """
+
+        parts = []
+        i = 0
+        while i < len(glob_pattern):
+            char = glob_pattern[i]
+            i += 1
+            if char == '*':
+                parts.append('.*')
+            elif char == '?':
+                parts.append('.')
+            elif char == '[':
+                end = glob_pattern.find(']', i + 1 if glob_pattern[i:i + 1] in ('!', '^') else i)
+                if end < 0:
+                    parts.append('\\[')
+                    continue
+                chars = glob_pattern[i:end].replace('\\', '\\\\')
+                if chars[:1] in ('!', '^'):
+                    chars = '^' + chars[1:]
+                parts.append('[' + chars + ']')
+                i = end + 1
+            else:
+                parts.append(re.escape(char))
+
+        return ''.join(parts)
+
+    def has_patterns(self):
+        """
+        :return: True if any entry is a glob or regular expression rather than an exact name.
+        """
+
+        return bool(self.prefixes) or bool(self.expressions)
+
+    def match(self, name):
+        """
+        :param name: A package name.
+        :return: True if name matches any of the entries.
+        """
+
+        if name in self.names:
+            return True
+        for length in self.prefix_lengths:
+            if length > len(name):
+                break
+            if name[:length] in self.prefixes[length]:
+                return True
+
+        return any(expression.match(name) is not None for expression in self.expressions)
+
+
+def release_date(release_data):
+    """
+    :param release_data: The contents of a Release file.
+    :return: The Date field of the Release file as a POSIX timestamp, or None if it has no parsable Date.
+    """
+
+    match = release_date_pattern.search(release_data)
+    if match is None:
+        return None
+    parsed = email.utils.parsedate_tz(match.group(1).strip())
+
+    return email.utils.mktime_tz(parsed) if parsed is not None else None
+
+
+def merge_diff_pkg_records(new_records, old_records):
+    """
+    Diffs two streams of package records that are both sorted by package name (as upstream Packages files and the
+    ones write_package_index produces are) by walking them together, so neither stream needs to be held in memory.
+    As with read_pkg_index_file, a name that appears more than once in a stream resolves to its last record.
+    :param new_records: Iterable of records from the newer index, in package name order.
+    :param old_records: Iterable of records from the older index, in package name order.
+    :return: Yields (status, new_record, old_record) tuples, where status is one of 'added' (old_record is None),
+    'upgraded' (new_record has the higher version), 'removed' (new_record is None) or 'unchanged' (the new version
+    is not higher than the old one.)
+    :raises ValueError: if either stream is not in package name order.
+    """
+
+    new_iter = last_pkg_records(new_records)
+    old_iter = last_pkg_records(old_records)
+    new_record = next(new_iter, None)
+    old_record = next(old_iter, None)
+
+    while new_record is not None or old_record is not None:
+        if old_record is None or (new_record is not None and new_record['Package'] < old_record['Package']):
+            yield 'added', new_record, None
+            new_record = next(new_iter, None)
+        elif new_record is None or old_record['Package'] < new_record['Package']:
+            yield 'removed', None, old_record
+            old_record = next(old_iter, None)
+        else:
+            if debian_version_key(new_record['Version']) > debian_version_key(old_record['Version']):
+                yield 'upgraded', new_record, old_record
+            else:
+                yield 'unchanged', new_record, old_record
+            new_record = next(new_iter, None)
+            old_record = next(old_iter, None)
+
+
+def last_pkg_records(records):
+    """
+    :param records: Iterable of package records in package name order.
+    :return: Yields the last record of each run of records with the same name.
+    :raises ValueError: if a record's name sorts before the name of the record ahead of it.
+    """
+
+    previous = None
+    for record in records:
+        if previous is not None:
+            if record['Package'] < previous['Package']:
+                raise ValueError('Package stream is not sorted by name at package {0}.'.format(record['Package']))
+            if record['Package'] != previous['Package']:
+                yield previous
+        previous = record
+    if previous is not None:
+        yield previous
+
+
+def parse_pdiff_index(data):
+    """
+    Parses a Packages.diff/Index file.  The SHA256 fields are used when present, SHA1 otherwise.
+    :param data: The contents of the Index file.
+    :return: A dictionary with keys 'hash' (the hashlib name of the hash used), 'current' ([hash, size] of the current
+    Packages file), 'history' (list of [hash, size, patch name] entries, oldest first, giving the hash of the Packages
+    file each patch applies to), 'patches' ({patch name: [hash, size]} of the uncompressed patches) and 'merged'
+    (True if the Index has X-Patch-Precedence: merged, i.e. each patch takes its file straight to the current one.)
+             None if the Index holds neither SHA256 nor SHA1 patch information.
+    """
+
+    fields = {}
+    key = ''
+    for line in data.splitlines():
+        if line.startswith(' '):
+            if key and line.strip():
+                fields[key].append(line.split())
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            fields[key] = [value.split()] if value.strip() else []
+
+    for prefix, hash_name in [('SHA256', 'sha256'), ('SHA1', 'sha1')]:
+        if prefix + '-History' in fields and prefix + '-Patches' in fields:
+            return {
+                'hash': hash_name,
+                'current': fields.get(prefix + '-Current', [[]])[0],
+                'history': [entry for entry in fields[prefix + '-History'] if len(entry) == 3],
+                'patches': dict((entry[2], entry[:2]) for entry in fields[prefix + '-Patches'] if len(entry) == 3),
+                'merged': fields.get('X-Patch-Precedence') == [['merged']],
+            }
+
+    return None
+
+
+def apply_ed_patch(lines, patch):
+    """
+    Applies an ed script of the form produced by diff --ed (as published in Packages.diff/) to a list of lines, in
+    place.  Only the a, c and d commands are supported; diff emits them from the bottom of the file up, so each can be
+    applied directly against the current line numbers.
+    :param lines: The file being patched, as a list of lines including their line endings.
+    :param patch: The text of the ed script.
+    :raises ValueError: if the script contains a command that is not supported.
+    """
+
+    patch_lines = patch.splitlines(True)
+    index = 0
+    while index < len(patch_lines):
+        command = patch_lines[index].rstrip('\n')
+        index += 1
+
+        match = ed_command_pattern.match(command)
+        if match is None:
+            if command in ('w', 'q', ''):
+                continue
+            raise ValueError('Unsupported ed command {0!r} in patch.'.format(command))
+
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else start
+        action = match.group(3)
+
+        text = []
+        if action != 'd':
+            while index < len(patch_lines) and patch_lines[index] != '.\n':
+                text.append(patch_lines[index])
+                index += 1
+            # Skip the terminating '.' line.
+            index += 1
+
+        if action == 'a':
+            lines[start:start] = text
+        elif action == 'c':
+            lines[start - 1:end] = text
+        else:
+            del lines[start - 1:end]
+
+
+def write_index_file(path, data, compression=None):
+    """
+    Writes data to path, optionally compressed, by way of a temporary file that is only renamed over path once it is
+    complete - so readers see either the old file or the new one, never a partial one.
+    :param path: The file to write.
+    :param data: The uncompressed contents.
+    :param compression: None, 'gz', 'bz2' or 'xz'.
+    :return: True if the file was written, False otherwise.
+    """
+
+    temp_path = path + '.new'
+    try:
+        raw_stream = None
+        if compression == 'gz':
+            # Handing GzipFile the real name keeps the temporary name out of the gzip header.
+            raw_stream = open(temp_path, 'wb')
+            stream = gzip.GzipFile(path, 'wb', fileobj=raw_stream)
+        elif compression == 'bz2':
+            stream = bz2.BZ2File(temp_path, 'w')
+        elif compression == 'xz':
+            stream = lzma.LZMAFile(temp_path, 'w')
+        else:
+            stream = open(temp_path, 'wb')
+        stream.write(data)
+        stream.close()
+        if raw_stream is not None:
+            raw_stream.close()
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(temp_path, owner, group)
+        os.rename(temp_path, path)
+    except (IOError, OSError) as err:
+        logger.error('Unable to write {0}: {1}'.format(path, err))
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return False
+
+    return True
+
+
+def hash_file(path, hash_type='sha256'):
+    """
+    Computes the hex digest of the file at path, reading it in fixed size chunks so that memory use stays bounded.
+    :param path: The file to hash.
+    :param hash_type: Name of any hashlib algorithm.
+    :return: The hex digest string, or None if the file could not be read.
+    """
+
+    digests = hash_file_multi(path, (hash_type,))
+    return digests[hash_type] if digests is not None else None
+
+
+def hash_file_multi(path, hash_types):
+    """
+    Computes several hex digests of the file at path in a single chunked pass over it.
+    :param path: The file to hash.
+    :param hash_types: Sequence of hashlib algorithm names.
+    :return: Dictionary of hex digests keyed by algorithm name, or None if the file could not be read.
+    """
+
+    hasher = MultiHasher(hash_types)
+    try:
+        hasher.update_from_file(path)
+    except IOError:
+        return None
+
+    return hasher.hexdigests()
+
+
+def hash_files(requests, workers=None):
+    """
+    Hashes a batch of files across a pool of threads.  hashlib releases the GIL while it digests large buffers, so
+    hashing several files at once scales with the number of cores.
+    :param requests: List of (path, hash_types) tuples.
+    :param workers: Number of hashing threads; defaults to hash_workers.
+    :return: Dictionary mapping each path to its hash_file_multi result (None if the file could not be hashed.)
+    """
+
+    def hash_request(path, hash_types):
+        try:
+            return hash_file_multi(path, hash_types)
+        except Exception as err:
+            # A failure must not leave the path out of the results.
+            logger.error('Unexpected error hashing {0}: {1}'.format(path, err))
+            return None
+
+    workers = min(hash_workers if workers is None else workers, len(requests))
+    if workers <= 1:
+        return dict((path, hash_request(path, hash_types)) for path, hash_types in requests)
+
+    request_queue = Queue.Queue()
+    for request in requests:
+        request_queue.put(request)
+    results = {}
+
+    def worker():
+        while True:
+            try:
+                path, hash_types = request_queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[path] = hash_request(path, hash_types)
+
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class MultiHasher:
+    """
+    Feeds one stream of data to several hashlib algorithms at once, so that a file only has to be read once however
+    many digests are needed of it.
+    """
+
+    def __init__(self, hash_types):
+        """
+        :param hash_types: Sequence of hashlib algorithm names.
+        """
+
+        self._hashers = [(hash_type, hashlib.new(hash_type)) for hash_type in hash_types]
+
+    def update(self, data):
+        for hash_type, hasher in self._hashers:
+            hasher.update(data)
+
+    def update_from_file(self, path):
+        """
+        Feeds the contents of the file at path to every hash, in chunks of hash_chunk_size.
+        :return: The number of bytes read.
+        """
+
+        size = 0
+        stream = open(path, 'rb')
+        try:
+            chunk = stream.read(hash_chunk_size)
+            while chunk:
+                self.update(chunk)
+                size += len(chunk)
+                chunk = stream.read(hash_chunk_size)
+        finally:
+            stream.close()
+
+        return size
+
+    def hexdigest(self, hash_type):
+        for name, hasher in self._hashers:
+            if name == hash_type:
+                return hasher.hexdigest()
+        raise KeyError(hash_type)
+
+    def hexdigests(self):
+        """
+        :return: Dictionary of the hex digests keyed by algorithm name.
+        """
+
+        return dict((hash_type, hasher.hexdigest()) for hash_type, hasher in self._hashers)
+
+
+class ConnectionPool:
+    """
+    Per-host pool of idle HTTP/1.1 keep-alive connections, shared by every download the plugin makes so that a sync
+    pays for one TCP handshake per mirror host rather than one per file.  Connections are checked out with acquire
+    and handed back with release once their reply has been read in full; callers close, rather than release,
+    connections that failed or that the server has asked to close.  The pool is safe to share between threads.
+    """
+
+    def __init__(self, max_idle=8):
+        """
+        :param max_idle: The maximum number of idle connections kept per host.  Extra connections released to the pool
+        are closed.
+        """
+
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, domain):
+        """
+        :return: Tuple of an HTTPConnection to domain and whether that connection has been used before.  Reused
+        connections may turn out to have been closed by the server in the meantime.
+        """
+
+        with self._lock:
+            idle = self._idle.get(domain)
+            if idle:
+                return idle.pop(), True
+
+        return httplib.HTTPConnection(domain), False
+
+    def release(self, domain, conn):
+        with self._lock:
+            idle = self._idle.setdefault(domain, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+
+        conn.close()
+
+    def close_all(self):
+        """
+        Closes every idle connection in the pool.
+        """
+
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+connection_pool = ConnectionPool()
+
+
+def split_remote_path(uri, path):
+    """
+    Splits a mirror uri and a path relative to it into the two parts httplib wants.
+    :param uri: The url string of the mirror.  Must contain at least the fqdn, may contain some of the remote host path.
+    :param path: The path on the remote webserver including the filename, relative to the end of the uri.
+    :return: Tuple of the domain and the full path on the remote host, starting with '/'.
+    """
+
+    # httplib wants the domain and the path to be completely separate, and not to include the http protocol portion.
+    # Test the uri here, split it apart if need be, and then join any path bits to the path bit that was passed to us.
+    # Check for the '://' that indicates the presence of the protocol specifier in a url.
+    if uri.find('://') >= 0:
+        logger.debug('uri contains protocol specifier - removing.')
+        partial_split = uri.split('://')
+        protocol = partial_split[0]
+        uri = partial_split[1]
+
+    # uri either had no protocol or has been overwritten such that no protocol component exists.  Check for path
+    # separator.
+    if uri.find('/') >= 0:
+        logger.debug('uri contains partial path - splitting apart.')
+        # split ONE time, at the first separator.
+        partial_split = uri.split('/', 1)
+        domain = partial_split[0]
+        uri_path = partial_split[1]
+    else:
+        domain = uri
+        uri_path = ''
+
+    # uri_path may be '' or it may be non-empty string.  It will not start with a / in either case.  Join it to the
+    # value of the path that was passed to us, if it is non-empty.
+    if uri_path.endswith('/') and path.startswith('/'):
+        full_path = uri_path[:-1] + path
+    elif not uri_path.endswith('/') and not path.startswith('/'):
+        full_path = uri_path + '/' + path
+    else:
+        full_path = uri_path + path
+
+    if not full_path.startswith('/'):
+        full_path = '/' + full_path
+
+    return domain, full_path
+
+
+def request_remote_file(domain, full_path, headers=None):
+    """
+    Sends a GET for full_path to domain over a connection from the shared connection_pool.  An idle pooled connection
+    may have been dropped by the server since it was last used, which only shows up once we try to use it - in that case
+    it is retired and the request is retried on a fresh connection.
+    :param domain: The remote host.
+    :param full_path: The path of the file on the remote host.
+    :param headers: Optional dictionary of extra request headers.
+    :return: Tuple of the connection and its reply.  The caller must read the reply and then hand the connection to
+    release_connection, or close it if the body was not read in full.
+    """
+
+    while True:
+        conn, reused = connection_pool.acquire(domain)
+        try:
+            conn.request("GET", full_path, headers=headers or {})
+            return conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            logger.debug("Pooled connection to %s was broken, retrying on a new connection.", domain)
+
+
+def release_connection(domain, conn, reply):
+    """
+    Returns conn to the connection pool once reply has been read in full, unless the server asked to close it.
+    """
+
+    if reply.will_close:
+        conn.close()
+    else:
+        connection_pool.release(domain, conn)
+
+
+def download_file(uri, path, cache_ts=None, validators=None, stats=None):
+    """
+    Given a uri and path including file, download_file will attempt to download that file.  See
+    download_file_with_validators for the parameters.
+    :return: The file contents, or None if the remote file has not changed since the cached copy.
+    """
+
+    reply = download_file_with_validators(uri, path, cache_ts, validators, stats)
+
+    return reply[0] if reply is not None else None
+
+
+def download_file_with_validators(uri, path, cache_ts=None, validators=None, stats=None):
+    """
+    Given a uri and path including file, download_file_with_validators will attempt to download that file.  If
+    cache_ts is set to a datetime object, the request is made conditional, so that callers can make use of cached
+    local copies of the file: the ETag and Last-Modified values previously recorded in validators are sent back to the
+    server (the cache_ts itself is used as If-Modified-Since when nothing has been recorded), and a 304 reply means the
+    cached copy is still current.  Either way only a single request is made.
+    :param uri: The url string to the file we are attempting to download.  Must contain at least the fqdn, may
+    contain some of the remote host path to the file.
+    :param path: The path on the remote webserver including the filename that we want to download.  The path
+    should be relative to the end of the domain and path in the uri.
+    :param cache_ts: A timestamp to compare the remote file time to.  If None, then the remote file will be
+    downloaded regardless of its last update time; if present (must be a datetime object) then the file is only
+    downloaded if the server reports it has changed.
+    :param validators: Optional DownloadValidators store to take the validators of a conditional request from.
+    Nothing is recorded in it here: the caller records the returned validators once it has verified the contents, so
+    that a later 304 can never vouch for a download that was rejected.
+    :param stats: Optional MirrorStats to record the latency, throughput or failure of the request against uri in.
+    :return: Tuple of the file contents and the ETag and Last-Modified values of the reply (either may be None), or
+    None if the remote file has not changed since the cached copy.
+    """
+    global logger
+
+    logger.debug("Attempting to download file %s from uri %s.", path, uri)
+    domain, full_path = split_remote_path(uri, path)
+
+    logger.debug("Opening http connection to remote server.")
+    headers = {}
+    if cache_ts is not None and isinstance(cache_ts, datetime.datetime):
+        entry = validators.get(uri, path) if validators is not None else None
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        else:
+            headers['If-Modified-Since'] = email.utils.formatdate(time.mktime(cache_ts.timetuple()), usegmt=True)
+        logger.debug("Making conditional request with headers %s.", headers)
+
+    logger.debug("Downloading file...")
+    try:
+        start = time.time()
+        conn, reply = request_remote_file(domain, full_path, headers)
+        first_byte = time.time()
+        # The body has to be read in full before the connection can be reused, even on a 304 or an error.
+        file_data = reply.read()
+    except (httplib.HTTPException, socket.error):
+        if stats is not None:
+            stats.record_error(uri)
+        raise
+    release_connection(domain, conn, reply)
+
+    if reply.status == 304:
+        if stats is not None:
+            stats.record(uri, first_byte - start)
+        logger.debug("Remote file has not been modified since the cached copy.")
+        return None
+
+    if reply.status != 200:
+        if stats is not None:
+            stats.record_error(uri)
+        logger.debug("URL %s, path %s were not found by httplib.", domain, full_path)
+        raise httplib.InvalidURL, domain + full_path + ' was not found.'
+
+    if stats is not None:
+        stats.record(uri, first_byte - start, len(file_data), time.time() - first_byte)
+
+    logger.debug("File downloaded, returning acquired data to caller.")
+    return file_data, reply.getheader('ETag'), reply.getheader('Last-Modified')
+
+
+def read_partial_download_state(dest_path, hash_value):
+    """
+    Looks for a partial download of dest_path left behind by an interrupted download_to_file.
+    :param dest_path: The local path the file is being downloaded to.
+    :param hash_value: The expected hex digest of the file.  A partial download of any other file is discarded.
+    :return: The recorded state of the partial download (a dictionary with 'hash_value', 'etag' and 'last_modified'
+    keys), or None if there is no usable partial download.
+    """
+
+    temp_path = dest_path + '.part'
+    state_path = temp_path + '.state'
+    try:
+        stream = open(state_path, 'r')
+        state = json.load(stream)
+        stream.close()
+    except (IOError, ValueError):
+        state = None
+
+    if state is not None and state.get('hash_value') == hash_value and os.path.isfile(temp_path):
+        return state
+
+    return None
+
+
+def remove_partial_download(dest_path):
+    for stale in (dest_path + '.part', dest_path + '.part.state'):
+        if os.path.exists(stale):
+            os.remove(stale)
+
+
+def download_to_file(uri, path, dest_path, hash_type, hash_value, stats=None, resume=True):
+    """
+    Streams a remote file to dest_path in chunks of download_chunk_size, hashing it on the way, so that memory use
+    stays bounded however large the file is.  The data is written to dest_path + '.part' and only renamed into place
+    once its hash has been verified; a copy that fails verification is removed.
+
+    If the download is interrupted the .part file is left in place, alongside a .part.state file recording which file
+    it is a part of and the remote validators it was downloaded against.  The next download of the same file asks the
+    server for just the missing bytes with a Range request (made conditional on the recorded validators through
+    If-Range), re-hashing the bytes already on disk to pick the hash back up; a server that ignores the range simply
+    sends the whole file again.
+    :param uri: The url string of the mirror to download from.
+    :param path: The path of the file on the remote webserver, relative to the end of the uri.
+    :param dest_path: The local path to save the file to.  Its directory must exist.
+    :param hash_type: The hashlib name of the hash to verify the file with.
+    :param hash_value: The expected hex digest of the file.
+    :param stats: Optional MirrorStats to record the latency, throughput or failure of the download from uri in.
+    :param resume: If False, any partial download is discarded and the whole file is downloaded.
+    :return: True if the file was downloaded and verified, False if it did not produce hash_value.  HTTP errors raise
+    httplib.HTTPException or socket.error as with download_file.
+    """
+
+    logger.debug("Streaming file %s from uri %s to %s.", path, uri, dest_path)
+    domain, full_path = split_remote_path(uri, path)
+    temp_path = dest_path + '.part'
+    state_path = temp_path + '.state'
+
+    headers = {}
+    offset = 0
+    state = read_partial_download_state(dest_path, hash_value) if resume else None
+    if state is None:
+        remove_partial_download(dest_path)
+    else:
+        offset = os.path.getsize(temp_path)
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        if state.get('etag') or state.get('last_modified'):
+            headers['If-Range'] = state.get('etag') or state.get('last_modified')
+        logger.debug("Resuming download of %s at byte %d.", path, offset)
+
+    try:
+        start = time.time()
+        conn, reply = request_remote_file(domain, full_path, headers)
+        first_byte = time.time()
+    except (httplib.HTTPException, socket.error):
+        if stats is not None:
+            stats.record_error(uri)
+        raise
+
+    if reply.status == 416 and offset:
+        # The partial file is no prefix of what the server has; start again from scratch.
+        reply.read()
+        release_connection(domain, conn, reply)
+        logger.debug("Server rejected resuming %s at byte %d; downloading it in full.", path, offset)
+        return download_to_file(uri, path, dest_path, hash_type, hash_value, stats, False)
+
+    if reply.status not in (200, 206):
+        reply.read()
+        release_connection(domain, conn, reply)
+        if stats is not None:
+            stats.record_error(uri)
+        logger.debug("URL %s, path %s were not found by httplib.", domain, full_path)
+        raise httplib.InvalidURL, domain + full_path + ' was not found.'
+
+    hash_obj = MultiHasher((hash_type,))
+    content_range = reply.getheader('Content-Range', '')
+    if reply.status == 206 and content_range.startswith('bytes {0}-'.format(offset)):
+        # Pick the hash state back up from the bytes already on disk, then append the rest.
+        hash_obj.update_from_file(temp_path)
+        stream = open(temp_path, 'ab')
+    elif reply.status == 206:
+        reply.read()
+        release_connection(domain, conn, reply)
+        logger.debug("Server sent an unexpected range %s for %s; downloading it in full.", content_range, path)
+        return download_to_file(uri, path, dest_path, hash_type, hash_value, stats, False)
+    else:
+        # Either a fresh download, or the server ignored the range - the body is the whole file.
+        offset = 0
+        stream = open(temp_path, 'wb')
+
+    state = {'hash_value': hash_value, 'etag': reply.getheader('ETag'),
+             'last_modified': reply.getheader('Last-Modified')}
+    state_stream = open(state_path, 'w+')
+    json.dump(state, state_stream)
+    state_stream.close()
+
+    size = 0
+    try:
+        chunk = reply.read(download_chunk_size)
+        while chunk:
+            hash_obj.update(chunk)
+            stream.write(chunk)
+            size += len(chunk)
+            chunk = reply.read(download_chunk_size)
+        stream.close()
+        # httplib does not complain about a body cut short when it is read in chunks, but leaves the missing byte count
+        # behind in length.
+        if reply.length:
+            raise httplib.IncompleteRead('', reply.length)
+    except Exception:
+        # The body was not read in full, so the connection can not be reused either.  What has been written so far is
+        # kept for the next attempt to resume from.
+        stream.close()
+        conn.close()
+        if stats is not None:
+            stats.record_error(uri)
+        raise
+    release_connection(domain, conn, reply)
+    os.remove(state_path)
+
+    if hash_obj.hexdigest(hash_type) != hash_value:
+        os.remove(temp_path)
+        if offset:
+            # The bytes we resumed from may not have been from the same file after all; only a full copy is proof
+            # that the mirror is serving bad data.
+            logger.debug("Resumed download of %s does not verify; downloading it in full.", path)
+            return download_to_file(uri, path, dest_path, hash_type, hash_value, stats, False)
+        if stats is not None:
+            stats.record_error(uri)
+        logger.error('Downloaded copy of {0} does not produce correct {1} hash value.  Expected {2}, produced '
+                     '{3}'.format(path, hash_type, hash_value, hash_obj.hexdigest(hash_type)))
+        return False
+
+    if stats is not None:
+        stats.record(uri, first_byte - start, size, time.time() - first_byte)
+
+    os.rename(temp_path, dest_path)
+    return True
+
+
+class BlobStore:
+    """
+    Content-addressed store of pool files shared between repositories.  Each file is kept once, as
+    <root>/<sha256[:2]>/<sha256>, and every repository pool that carries it holds a hardlink to that blob rather than a
+    copy - so a package that turns up in several mirrored suites is only downloaded and stored once.  The link count of
+    a blob doubles as its reference count: a blob whose only remaining link is the store's own is no longer used by any
+    pool, and is removed by gc.  The store and the pools must be on the same filesystem.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: The directory the blobs are kept under.
+        """
+
+        self.root = root
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def link(self, sha256, dest_path):
+        """
+        Hardlinks the blob with the given SHA256 to dest_path, replacing whatever was there.
+        :return: True if dest_path is now the blob, False if the store has no such blob or it could not be linked.
+        """
+
+        blob = self.blob_path(sha256)
+        temp_path = dest_path + '.link'
+        try:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            os.link(blob, temp_path)
+            os.rename(temp_path, dest_path)
+        except OSError as err:
+            if os.path.exists(blob):
+                logger.error('Unable to link blob {0} to {1}: {2}'.format(blob, dest_path, err))
+            return False
+
+        return True
+
+    def add(self, sha256, file_path):
+        """
+        Adds a verified pool file to the store, by hardlinking it in as the blob for sha256.  If the store already has
+        that blob (another repository got there first), file_path is replaced by a link to it instead.
+        """
+
+        blob = self.blob_path(sha256)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, file_path):
+                self.link(sha256, file_path)
+            return
+
+        blob_dir = os.path.dirname(blob)
+        try:
+            if not os.path.exists(blob_dir):
+                os.makedirs(blob_dir, conf.pkg_manager.default_perms)
+                owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+                group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+                os.chown(blob_dir, owner, group)
+            os.link(file_path, blob)
+        except OSError as err:
+            # Most likely a concurrent add of the same blob, or a store on another filesystem; either way the pool
+            # file itself is fine.
+            logger.error('Unable to add {0} to the blob store: {1}'.format(file_path, err))
+
+    def gc(self):
+        """
+        Removes every blob that is no longer linked from any pool.
+        :return: The number of blobs removed.
+        """
+
+        removed = 0
+        for blob_dir in glob.glob(os.path.join(self.root, '*')):
+            for blob in glob.glob(os.path.join(blob_dir, '*')):
+                try:
+                    if os.stat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        removed += 1
+                except OSError:
+                    continue
+            # Another repository sharing the store may be adding a blob to this directory right now.
+            try:
+                if not os.listdir(blob_dir):
+                    os.rmdir(blob_dir)
+            except OSError as err:
+                if err.errno not in (errno.ENOTEMPTY, errno.ENOENT):
+                    logger.error('Unable to remove empty blob directory {0}: {1}'.format(blob_dir, err))
+
+        logger.debug('Removed {0} unreferenced blobs from the blob store {1}.'.format(removed, self.root))
+        return removed
+
+
+class HashManifest:
+    """
+    Persisted record of the hashes of local files.  Each entry is keyed by the file's path and remembers the size,
+    modification time and inode the file had when it was hashed; a lookup only returns a hash while the file still
+    has all three, so a file that has been changed or replaced is simply hashed again.  The manifest is a JSON file,
+    written by save.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the JSON file backing the manifest.
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            stream = open(path, 'r')
+            self._entries = json.load(stream)
+            stream.close()
+        except (IOError, ValueError):
+            self._entries = {}
+
+    @staticmethod
+    def _signature(stat_result):
+        return [stat_result.st_size, stat_result.st_mtime, stat_result.st_ino]
+
+    def lookup(self, file_path, hash_type, stat_result=None):
+        """
+        :return: The recorded hex digest of file_path for hash_type, or None if there is none or the file has changed
+        since it was recorded.
+        """
+
+        if stat_result is None:
+            try:
+                stat_result = os.stat(file_path)
+            except OSError:
+                return None
+
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry[0] != self._signature(stat_result):
+                return None
+            return entry[1].get(hash_type)
+
+    def record(self, file_path, hash_type, value, stat_result=None):
+        """
+        Records value as the hash_type hex digest of file_path as it currently stands on disk.
+        """
+
+        if stat_result is None:
+            stat_result = os.stat(file_path)
+
+        signature = self._signature(stat_result)
+        with self._lock:
+            entry = self._entries.get(file_path)
+            if entry is None or entry[0] != signature:
+                entry = self._entries[file_path] = [signature, {}]
+            entry[1][hash_type] = value
+
+    def get_hashes_many(self, requests):
+        """
+        Looks up the hashes of a batch of files.  Digests that are current in the manifest are reused; the rest are
+        computed, in parallel by hash_files, and recorded.
+        :param requests: List of (file_path, hash_types, stat_result) tuples.
+        :return: Dictionary mapping each file_path to a dictionary of its hex digests keyed by hash type, or to None
+        if the file could not be read.
+        """
+
+        results = {}
+        missing = []
+        for file_path, hash_types, stat_result in requests:
+            digests = {}
+            for hash_type in hash_types:
+                value = self.lookup(file_path, hash_type, stat_result)
+                if value is not None:
+                    digests[hash_type] = value
+            results[file_path] = digests
+
+            missing_types = [hash_type for hash_type in hash_types if hash_type not in digests]
+            if missing_types:
+                missing.append((file_path, missing_types, stat_result))
+
+        computed = hash_files([(file_path, hash_types) for file_path, hash_types, stat_result in missing])
+        for file_path, hash_types, stat_result in missing:
+            digests = computed.get(file_path)
+            if digests is None:
+                results[file_path] = None
+                continue
+            for hash_type, value in digests.items():
+                self.record(file_path, hash_type, value, stat_result)
+            results[file_path].update(digests)
+
+        return results
+
+    def prune(self, file_paths):
+        """
+        Forgets every file that is not in file_paths.
+        """
+
+        keep = set(file_paths)
+        with self._lock:
+            for file_path in self._entries.keys():
+                if file_path not in keep:
+                    del self._entries[file_path]
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries)
+
+        try:
+            stream = open(self.path, 'w+')
+            stream.write(data)
+            stream.close()
+        except IOError:
+            logger.error('Unable to save hash manifest {0}.'.format(self.path))
+            return
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(self.path, owner, group)
+
+
+class MirrorStats:
+    """
+    Persisted per-mirror performance figures: exponentially weighted averages of request latency, download throughput
+    and error rate, updated by every download made with the stats object and saved as JSON in the cache directory so
+    that they carry over between syncs.  rank orders the mirrors by the expected time to fetch a typical package from
+    them, so that downloads go to the mirrors that have been performing best.  Updates are safe to make from several
+    threads.
+    """
+
+    # Weight given to each new sample in the running averages.
+    weight = 0.3
+    # Size, in bytes, of the download mirrors are compared on.
+    reference_size = 1048576
+    # Downloads smaller than this mostly measure latency, so they are not used as throughput samples.
+    min_throughput_sample = 65536
+    # Latency, in seconds, assumed for mirrors that have only ever failed.
+    default_latency = 1.0
+
+    def __init__(self, path):
+        """
+        :param path: The path of the JSON file backing the stats.
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            stream = open(path, 'r')
+            self._stats = json.load(stream)
+            stream.close()
+        except (IOError, ValueError):
+            self._stats = {}
+
+    def _average(self, url, key, sample):
+        entry = self._stats.setdefault(url, {})
+        if entry.get(key) is None:
+            entry[key] = sample
+        else:
+            entry[key] += self.weight * (sample - entry[key])
+
+    def record(self, url, latency, size=0, duration=0.0):
+        """
+        Records a successful request to url.
+        :param latency: Seconds from sending the request to receiving the reply headers.
+        :param size: Size of the body that was read, in bytes.
+        :param duration: Seconds spent reading the body.
+        """
+
+        with self._lock:
+            self._average(url, 'latency', latency)
+            self._average(url, 'error_rate', 0.0)
+            if size >= self.min_throughput_sample and duration > 0:
+                self._average(url, 'throughput', size / duration)
+
+    def record_error(self, url):
+        """
+        Records a failed request or a bad download from url.
+        """
+
+        with self._lock:
+            self._average(url, 'error_rate', 1.0)
+
+    def score(self, url):
+        """
+        :return: The expected number of seconds to fetch reference_size bytes from url, allowing for retries of failed
+        downloads.  Mirrors with no recorded history score 0 so that they are tried, and measured, first.
+        """
+
+        entry = self._stats.get(url)
+        if not entry:
+            return 0.0
+
+        expected = entry['latency'] if entry.get('latency') is not None else self.default_latency
+        if entry.get('throughput'):
+            expected += self.reference_size / entry['throughput']
+
+        return expected / max(0.05, 1.0 - entry.get('error_rate', 0.0))
+
+    def rank(self, urls):
+        """
+        :return: List of urls ordered from best to worst score.  Mirrors with equal scores keep their order in urls.
+        """
+
+        return sorted(urls, key=self.score)
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._stats)
+
+        try:
+            stream = open(self.path, 'w+')
+            stream.write(data)
+            stream.close()
+        except IOError:
+            logger.error('Unable to save mirror statistics to {0}.'.format(self.path))
+            return
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(self.path, owner, group)
+
+
+class PackageDownloader:
+    """
+    Downloads pool files concurrently with a bounded pool of worker threads.  Each package goes to the best ranked
+    mirror in stats that has one of its mirror_connections download slots free, and on failure moves on to the next
+    best mirror it has not tried yet; as failures are recorded in stats, later packages are routed away from a failing
+    mirror.  Packages are verified in the worker by download_to_file.  A mirror whose copy of a package fails
+    verification is removed from the urls list as potentially tainted, as with the Release and index files.  Completed
+    downloads are handed back to the calling thread, which does all of the bookkeeping.
+    """
+
+    def __init__(self, urls, stats, workers=4, mirror_connections=2):
+        """
+        :param urls: The repository's list of mirror urls.  The list is shared, not copied, so that tainted mirrors
+        are dropped for the rest of the sync.
+        :param stats: The repository's MirrorStats, used to rank the mirrors and updated by every download.
+        :param workers: The number of packages downloaded at once.
+        :param mirror_connections: The maximum number of simultaneous downloads from any one mirror.
+        """
+
+        self.urls = urls
+        self.stats = stats
+        self.workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._mirror_slots = dict((url, threading.BoundedSemaphore(max(1, mirror_connections))) for url in urls)
+
+    def run(self, jobs):
+        """
+        Downloads every job, yielding the results as the downloads complete (so not necessarily in order).
+        :param jobs: List of (package, dest_path, hash_type, hash_value) tuples.  The package's Filename is downloaded
+        to dest_path and verified against hash_value.
+        :return: Generator of (job, success) tuples.
+        """
+
+        job_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+
+        threads = []
+        for i in range(min(self.workers, len(jobs))):
+            thread = threading.Thread(target=self._worker, args=(job_queue, result_queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for i in range(len(jobs)):
+            yield result_queue.get()
+
+        for thread in threads:
+            thread.join()
+
+    def _worker(self, job_queue, result_queue):
+        while True:
+            try:
+                job = job_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                success = self.fetch(*job)
+            except Exception:
+                logger.exception('Unexpected error downloading package {0}.'.format(job[0]['Filename']))
+                success = False
+            result_queue.put((job, success))
+
+    def fetch(self, package, dest_path, hash_type, hash_value):
+        """
+        Downloads a single package, trying the mirrors from best to worst until one provides a valid copy.
+        :return: True if a verified copy of the package is now at dest_path, False otherwise.
+        """
+
+        tried = set()
+        while True:
+            with self._lock:
+                candidates = [url for url in self.stats.rank(self.urls) if url not in tried]
+            if not candidates:
+                return False
+
+            url = self._acquire_mirror(candidates)
+            tried.add(url)
+            try:
+                if download_to_file(url, package['Filename'], dest_path, hash_type, hash_value, self.stats):
+                    return True
+            except (httplib.HTTPException, socket.error, IOError) as err:
+                logger.error('Unable to download package {0} from {1}: {2}  '
+                             'Trying next...'.format(package['Filename'], url, err))
+                continue
+            finally:
+                self._mirror_slots[url].release()
+
+            # The mirror served the package, but not the package its index promised.
+            self.drop_mirror(url)
+
+    def _acquire_mirror(self, candidates):
+        """
+        Takes a download slot on the best of the candidate mirrors that has one free, waiting on the best mirror if all
+        of them are busy.
+        :return: The mirror whose slot was taken.  The caller must release it.
+        """
+
+        for url in candidates:
+            if self._mirror_slots[url].acquire(False):
+                return url
+
+        self._mirror_slots[candidates[0]].acquire()
+        return candidates[0]
+
+    def drop_mirror(self, url):
+        with self._lock:
+            if url in self.urls:
+                logger.error('Removing URL {0} from the url list as potentially tainted.'.format(url))
+                self.urls.remove(url)
+
+
+class DownloadValidators:
+    """
+    Small persistent store of the ETag and Last-Modified values returned with downloaded files, keyed by host and
+    path.  download_file sends them back as If-None-Match/If-Modified-Since, so that refreshing an unchanged file costs
+    one round trip and no body.  Callers only record validators once the download they came with has been verified,
+    together with the Release hash it was verified against where there is one, so that a conditional request is only
+    made while the Release file still lists the same contents.  The store is a JSON file, loaded on first use and
+    rewritten on every change.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the JSON file backing the store.
+        """
+
+        self.path = path
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            try:
+                stream = open(self.path, 'r')
+                self._entries = json.load(stream)
+                stream.close()
+            except (IOError, ValueError):
+                self._entries = {}
+
+        return self._entries
+
+    def get(self, uri, path):
+        """
+        :param uri: The url string of the mirror, as passed to download_file.
+        :param path: The path of the file relative to uri, as passed to download_file.
+        :return: Dictionary with 'etag', 'last_modified' and 'release_hash' keys (any may be None) for the file, or
+        None.
+        """
+
+        url = ''.join(split_remote_path(uri, path))
+        with self._lock:
+            return self._load().get(url)
+
+    def update(self, uri, path, etag, last_modified, release_hash=None):
+        """
+        Records the validators returned with a verified download of path from uri, or forgets the file if the server
+        returned none.
+        :param release_hash: The hash the Release file listed for the download when it was verified, if any.
+        """
+
+        url = ''.join(split_remote_path(uri, path))
+        with self._lock:
+            entries = self._load()
+            if etag is None and last_modified is None:
+                if entries.pop(url, None) is None:
+                    return
+            else:
+                entries[url] = {'etag': etag, 'last_modified': last_modified, 'release_hash': release_hash}
+            data = json.dumps(entries)
+
+        try:
+            stream = open(self.path, 'w+')
+            stream.write(data)
+            stream.close()
+        except IOError:
+            logger.error('Unable to save download validators to {0}.'.format(self.path))
+            return
+
+        owner = pwd.getpwnam(conf.pkg_manager.default_owner)[2] if conf.pkg_manager.default_owner else -1
+        group = grp.getgrnam(conf.pkg_manager.default_group)[2] if conf.pkg_manager.default_group else -1
+        os.chown(self.path, owner, group)
+
+
+class PackageRecord(object):
+    """
+    Compact representation of a single Packages stanza, used in place of a plain dictionary so that the remote index,
+    the local index and the update list of a sync can all be held at once without each stanza carrying its own copy
+    of every field name.
+
+    The record's one representation is the raw text of its stanza, as read from the index, together with the offsets
+    of its Filename field.  Records are written back out as that text (see stanza_text), so upstream field order and
+    multi-line fields such as Description are kept byte for byte; setting Filename, the only field the plugin changes,
+    just patches its line in place.  The values of the fields nearly every binary stanza carries are derived from the
+    text into slots when it is read, with the values that repeat across thousands of stanzas (Maintainer, Section and
+    so on) interned; all other fields are read straight from the text when asked for.  Changing any field rewrites
+    its lines in the text and its slot together.  The class supports the subset of the dictionary interface that the
+    plugin uses on package records.
+    """
+
+    # Fields whose values are held in slots.
+    common_fields = ('Package', 'Source', 'Version', 'Installed-Size', 'Maintainer', 'Architecture', 'Provides',
+                     'Pre-Depends', 'Depends', 'Recommends', 'Filename', 'Size', 'MD5sum', 'SHA1', 'SHA256',
+                     'Section', 'Priority')
+    interned_fields = frozenset(['Source', 'Maintainer', 'Architecture', 'Section', 'Priority'])
+
+    __slots__ = tuple(field.lower().replace('-', '_') for field in common_fields) + ('_raw', '_filename_span')
+
+    slot_names = dict((field, field.lower().replace('-', '_')) for field in common_fields)
+
+    # Bumped whenever the pickled layout changes, so that snapshots of an older layout are not loaded.
+    state_version = 2
+
+    def __init__(self, fields=None):
+        """
+        Creates a record, optionally populated from a dictionary or list of (field, value) pairs.
+        """
+
+        for slot in PackageRecord.__slots__:
+            setattr(self, slot, None)
+        self._raw = ''
+
+        if fields:
+            for key, value in (fields.items() if hasattr(fields, 'items') else fields):
+                self[key] = value
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in PackageRecord.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(PackageRecord.__slots__, state):
+            setattr(self, slot, value)
+        # Unpickled strings are fresh copies; intern the repetitive values again.
+        for field in PackageRecord.interned_fields:
+            slot = PackageRecord.slot_names[field]
+            if getattr(self, slot) is not None:
+                setattr(self, slot, intern(getattr(self, slot)))
+
+    def set_stanza(self, text, filename_span):
+        """
+        Used by read_package_record: stores the raw text of the stanza the record was read from.  The values of the
+        common fields are stored with add_field.
+        :param text: The stanza, every line newline terminated, without the blank separator line.
+        :param filename_span: (start, end) offsets of the Filename field within text, or None if it has none.
+        """
+
+        self._raw = text
+        self._filename_span = filename_span
+
+    def add_field(self, key, value):
+        """
+        Used by read_package_record while parsing: stores the value of a common field in its slot.  Other fields are
+        read from the raw stanza when they are asked for.
+        """
+
+        slot = PackageRecord.slot_names.get(key)
+        if slot is not None:
+            setattr(self, slot, intern(value) if key in PackageRecord.interned_fields else value)
+
+    def stanza_text(self):
+        """
+        :return: The text of the stanza, every line newline terminated, without a blank separator line.
+        """
+
+        return self._raw
+
+    def _field_span(self, key):
+        """
+        :return: The (start, end) offsets of the lines of field key within the raw stanza, or None.
+        """
+
+        if key == 'Filename' and self._filename_span is not None:
+            return self._filename_span
+
+        text = self._raw
+        prefix = key + ':'
+        if text.startswith(prefix):
+            start = 0
+        else:
+            start = text.find('\n' + prefix)
+            if start < 0:
+                return None
+            start += 1
+
+        # The field runs until the next line that does not start with whitespace.
+        end = text.find('\n', start)
+        while 0 <= end < len(text) - 1 and text[end + 1] in ' \t':
+            end = text.find('\n', end + 1)
+
+        return start, len(text) if end < 0 else end + 1
+
+    def field_text(self, key):
+        """
+        :param key: The name of a field the record holds.
+        :return: The text of the field as it appears in the stanza, ending in a newline.
+        """
+
+        span = self._field_span(key)
+        if span is None:
+            raise KeyError(key)
+
+        return self._raw[span[0]:span[1]]
+
+    def _replace_field(self, key, text):
+        """
+        Replaces the lines of field key in the raw stanza with text (appending it if the field is not there yet, or
+        removing the field if text is empty), and keeps the Filename offsets in step.
+        """
+
+        span = self._field_span(key)
+        if span is None:
+            if not text:
+                raise KeyError(key)
+            span = (len(self._raw), len(self._raw))
+
+        self._raw = self._raw[:span[0]] + text + self._raw[span[1]:]
+
+        if key == 'Filename':
+            self._filename_span = (span[0], span[0] + len(text)) if text else None
+        elif self._filename_span is not None and self._filename_span[0] >= span[1]:
+            shift = len(text) - (span[1] - span[0])
+            self._filename_span = (self._filename_span[0] + shift, self._filename_span[1] + shift)
+
+    def __getitem__(self, key):
+        slot = PackageRecord.slot_names.get(key)
+        if slot is not None:
+            value = getattr(self, slot)
+            if value is None:
+                raise KeyError(key)
+            return value
+
+        lines = self.field_text(key).splitlines()
+        value = lines[0].split(':', 1)[1].strip() if ':' in lines[0] else ''
+        for line in lines[1:]:
+            value += line.strip()
+        return value.strip()
+
+    def __setitem__(self, key, value):
+        self._replace_field(key, key + ': ' + value + '\n')
+        slot = PackageRecord.slot_names.get(key)
+        if slot is not None:
+            setattr(self, slot, intern(value) if key in PackageRecord.interned_fields else value)
+
+    def __delitem__(self, key):
+        self._replace_field(key, '')
+        slot = PackageRecord.slot_names.get(key)
+        if slot is not None:
+            setattr(self, slot, None)
+
+    def __contains__(self, key):
+        slot = PackageRecord.slot_names.get(key)
+        if slot is not None:
+            return getattr(self, slot) is not None
+        return self._field_span(key) is not None
+
+    def __iter__(self):
+        # Fields in stanza order; every field starts on a line without leading whitespace.
+        for line in self._raw.splitlines():
+            if line and not line[0].isspace():
+                yield line.split(':', 1)[0].strip()
+
+    def __len__(self):
+        return sum(1 for line in self._raw.splitlines() if line and not line[0].isspace())
+
+    def __nonzero__(self):
+        return bool(self._raw)
+
+    def __repr__(self):
+        return 'PackageRecord({0!r})'.format(self.items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(field, self[field]) for field in self]
+
+    def iteritems(self):
+        for field in self:
+            yield field, self[field]
+
+
+class MappedPackageIndex:
+    """
+    Read-only, dictionary-like view of an uncompressed Packages file.  The file is memory-mapped and a single scan
+    builds a {pkg_name: (offset, length)} table of its stanzas; a stanza is only parsed into a package record (by the
+    record_reader callable, normally DebianPkgManager.read_package_record) the first time it is looked up.  As with
+    read_pkg_index_file, a name that appears more than once resolves to its last stanza.  The same scan collects the
+    Provides field of every stanza that has one into the provides dictionary, for dependency resolution.
+    """
+
+    def __init__(self, path, record_reader):
+        """
+        Maps the file at path and indexes its stanzas.
+        :param path: The path to the uncompressed Packages file.
+        :param record_reader: Callable that takes a stream and returns the next package record from it.
+        """
+
+        self.path = path
+        self._record_reader = record_reader
+        self._offsets = {}
+        self._records = {}
+        self.provides = {}
+
+        stream = open(path, 'rb')
+        try:
+            if os.fstat(stream.fileno()).st_size > 0:
+                self._data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # mmap refuses zero length files; an empty string indexes just as well.
+                self._data = ''
+        finally:
+            stream.close()
+
+        self._build_offsets()
+
+    def _build_offsets(self):
+        """
+        Single pass over the mapped file recording the offset and length of every stanza under its Package name.
+        The length includes the newline that ends the last line of the stanza, but not the blank separator line.
+        """
+
+        data = self._data
+        size = len(data)
+        start = 0
+        while start < size:
+            # Skip any run of blank lines between stanzas.
+            while start < size and data[start] == '\n':
+                start += 1
+            if start >= size:
+                break
+
+            end = data.find('\n\n', start)
+            end = size if end < 0 else end + 1
+
+            # Package: is conventionally the first line of the stanza, but is not required to be.
+            if data[start:start + 8] == 'Package:':
+                field = start
+            else:
+                field = data.find('\nPackage:', start, end)
+                field = field + 1 if field >= 0 else -1
+            if field >= 0:
+                line_end = data.find('\n', field, end)
+                line_end = end if line_end < 0 else line_end
+                name = data[field + 8:line_end].strip()
+                self._offsets[name] = (start, end - start)
+                self._scan_provides(name, start, end)
+            else:
+                logger.warn('Stanza at offset {0} of {1} has no Package field.  Skipping.'.format(start, self.path))
+
+            start = end
+
+    def _scan_provides(self, name, start, end):
+        """
+        Records the Provides field (continuation lines included) of the stanza between start and end, if it has one.
+        """
+
+        data = self._data
+        if data[start:start + 9] == 'Provides:':
+            field = start
+        else:
+            field = data.find('\nProvides:', start, end)
+            if field < 0:
+                self.provides.pop(name, None)
+                return
+            field += 1
+
+        line_end = data.find('\n', field, end)
+        while 0 <= line_end < end - 1 and data[line_end + 1] in ' \t':
+            line_end = data.find('\n', line_end + 1, end)
+        line_end = end if line_end < 0 else line_end
+        self.provides[name] = ' '.join(data[field + 9:line_end].split())
+
+    def __contains__(self, name):
+        return name in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def keys(self):
+        return self._offsets.keys()
+
+    def __getitem__(self, name):
+        try:
+            return self._records[name]
+        except KeyError:
+            pass
+
+        record = self._parse(name)
+        self._records[name] = record
+
+        return record
+
+    def _parse(self, name):
+        offset, length = self._offsets[name]
+        stanza = self._data[offset:offset + length]
+        # read_package_record stores the final field of a record when it reaches the blank separator line, which the
+        # last stanza of a file may not have.
+        if not stanza.endswith('\n'):
+            stanza += '\n'
+        return self._record_reader(StringIO.StringIO(stanza + '\n'))
+
+    def get(self, name, default=None):
+        return self[name] if name in self._offsets else default
+
+    def iter_records(self, names):
+        """
+        Yields the records of names, in the order given.  Records are handed over rather than kept: any that an earlier
+        lookup parsed are released from the view as they are yielded, and the rest are parsed as they are reached.
+        :param names: Iterable of package names in the index.
+        """
+
+        for name in names:
+            record = self._records.pop(name, None)
+            yield record if record is not None else self._parse(name)
+
+    def close(self):
+        """
+        Releases the memory map.  Records that have already been parsed remain valid.
+        """
+
+        if not isinstance(self._data, str):
+            self._data.close()
+        self._data = ''
 
 
 class NullHandler(logging.Handler):
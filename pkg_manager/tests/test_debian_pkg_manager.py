@@ -0,0 +1,330 @@
+"""
+Unit tests for the module level helpers of the debian package manager plugin.  Run from the pkg_manager directory
+with: python -m unittest discover -s tests -t .
+"""
+
+import cPickle
+import logging
+import os
+import shutil
+import StringIO
+import subprocess
+import tempfile
+import unittest
+
+from repo_plugins import debian_pkg_manager
+
+
+def setUpModule():
+    # The plugin only sets its logger up in initialize().
+    debian_pkg_manager.logger = logging.getLogger('debian_pkg_manager')
+    debian_pkg_manager.logger.addHandler(debian_pkg_manager.NullHandler())
+
+
+class WhitelistMatcherTest(unittest.TestCase):
+
+    def matcher(self, *entries):
+        return debian_pkg_manager.WhitelistMatcher(dict((entry, ['binary']) for entry in entries), 'binary')
+
+    def test_exact_names_and_globs(self):
+        matcher = self.matcher('bash', 'linux-image-*', 'lib[!x]?ib', 'python3-?ix')
+        self.assertTrue(matcher.match('bash'))
+        self.assertFalse(matcher.match('bashx'))
+        self.assertTrue(matcher.match('linux-image-5.10'))
+        self.assertFalse(matcher.match('linux-imag'))
+        self.assertTrue(matcher.match('libzlib'))
+        self.assertFalse(matcher.match('libxlib'))
+        self.assertTrue(matcher.match('python3-six'))
+
+    def test_combined_expressions_match_whole_names(self):
+        matcher = self.matcher('/(foo|bar)[0-9]+/', '/baz/', 'qu?x*')
+        self.assertTrue(matcher.match('foo12'))
+        self.assertTrue(matcher.match('bar1'))
+        self.assertFalse(matcher.match('foo'))
+        self.assertFalse(matcher.match('foo12x'))
+        self.assertTrue(matcher.match('baz'))
+        self.assertFalse(matcher.match('bazz'))
+        self.assertTrue(matcher.match('quux-tools'))
+
+    def test_backreferences_keep_their_own_groups(self):
+        matcher = self.matcher('/(b)\\1/', '/(a)\\1/')
+        self.assertTrue(matcher.match('aa'))
+        self.assertTrue(matcher.match('bb'))
+        self.assertFalse(matcher.match('ab'))
+
+    def test_inline_flags_do_not_leak(self):
+        matcher = self.matcher('/(?i)foo/', '/bar/')
+        self.assertTrue(matcher.match('FOO'))
+        self.assertTrue(matcher.match('bar'))
+        self.assertFalse(matcher.match('BAR'))
+
+    def test_many_capturing_groups(self):
+        entries = ['/lib{0}-(a|b)/'.format(index) for index in range(120)]
+        entries.append('/' + '(x)' * 150 + '/')
+        matcher = self.matcher(*entries)
+        self.assertTrue(matcher.match('lib0-a'))
+        self.assertTrue(matcher.match('lib119-b'))
+        self.assertFalse(matcher.match('lib120-a'))
+        self.assertFalse(matcher.match('x' * 150))
+
+    def test_invalid_expression_and_other_categories_are_ignored(self):
+        matcher = debian_pkg_manager.WhitelistMatcher({'/bad(/': ['binary'], 'src-*': ['source']}, 'binary')
+        self.assertFalse(matcher.has_patterns())
+        self.assertFalse(matcher.match('bad('))
+        self.assertFalse(matcher.match('src-tools'))
+
+
+class ResolverTest(unittest.TestCase):
+
+    index = {
+        'app': {'Version': '1', 'Depends': 'mta | mail-transport-agent, libx (>= 2.0), perl:any',
+                'Recommends': 'editor'},
+        'tool': {'Version': '1', 'Depends': 'libold (<< 1.0), mail-transport-agent'},
+        'mta': {'Version': '1'},
+        'postfix': {'Version': '3'},
+        'libx': {'Version': '1.5'},
+        'libx2': {'Version': '2.1'},
+        'libold': {'Version': '1.2'},
+        'perl': {'Version': '5'},
+        'nano': {'Version': '2'},
+    }
+    provides = {'postfix': 'mail-transport-agent', 'libx2': 'libx (= 2.1)', 'nano': 'editor'}
+
+    def test_parse_relations(self):
+        self.assertEqual(debian_pkg_manager.parse_relations('libc6 (>= 2.14), debconf | debconf-2.0, python3:any, '
+                                                            'foo [amd64] <!nocheck>, bar (<<1:2~rc1)'),
+                         ((('libc6', '>=', '2.14'),),
+                          (('debconf', None, None), ('debconf-2.0', None, None)),
+                          (('python3', None, None),),
+                          (('foo', None, None),),
+                          (('bar', '<<', '1:2~rc1'),)))
+
+    def test_version_satisfies(self):
+        self.assertTrue(debian_pkg_manager.version_satisfies('2.1', '>=', '2.0'))
+        self.assertFalse(debian_pkg_manager.version_satisfies('2.0~rc1', '>=', '2.0'))
+        self.assertTrue(debian_pkg_manager.version_satisfies('1:1.0', '>>', '9.9'))
+        self.assertFalse(debian_pkg_manager.version_satisfies(None, '=', '1'))
+        self.assertTrue(debian_pkg_manager.version_satisfies(None, None, None))
+
+    def test_first_satisfying_alternative_is_chosen(self):
+        graph = debian_pkg_manager.DependencyGraph(self.index, self.provides)
+        reached, missing = graph.closure(['app'])
+        # mta is listed first; libx is too old, so the versioned Provides of libx2 satisfies libx (>= 2.0); the
+        # editor recommendation is only provided by nano.
+        self.assertEqual(reached, set(['app', 'mta', 'libx2', 'perl', 'nano']))
+        self.assertEqual(missing, {})
+
+    def test_mirrored_alternative_is_preferred(self):
+        graph = debian_pkg_manager.DependencyGraph(self.index, self.provides, mirrored=set(['postfix']))
+        reached, missing = graph.closure(['app'])
+        self.assertIn('postfix', reached)
+        self.assertNotIn('mta', reached)
+
+    def test_reached_alternative_is_preferred(self):
+        graph = debian_pkg_manager.DependencyGraph(self.index, self.provides)
+        reached, missing = graph.closure(['postfix', 'app'])
+        self.assertNotIn('mta', reached)
+
+    def test_unversioned_provides_do_not_satisfy_versioned_relations(self):
+        index = {'app': {'Version': '1', 'Depends': 'virtual (>= 1)'}, 'provider': {'Version': '5'}}
+        graph = debian_pkg_manager.DependencyGraph(index, {'provider': 'virtual'})
+        reached, missing = graph.closure(['app'])
+        self.assertEqual(reached, set(['app']))
+        self.assertEqual(missing, {'virtual (>= 1)': 'app'})
+
+    def test_unsatisfiable_relations_are_reported(self):
+        graph = debian_pkg_manager.DependencyGraph(self.index, self.provides)
+        reached, missing = graph.closure(['tool'])
+        self.assertEqual(reached, set(['tool', 'postfix']))
+        self.assertEqual(missing, {'libold (<< 1.0)': 'tool'})
+
+
+class VersionKeyTest(unittest.TestCase):
+
+    # (lower or equal version, relation, higher or equal version), in dpkg order.
+    table = [
+        ('1.0~rc1', '<', '1.0'),
+        ('1.0~~', '<', '1.0~'),
+        ('1.0~~a', '<', '1.0~'),
+        ('1.0~', '<', '1.0'),
+        ('1.0~rc1', '<', '1.0~rc2'),
+        ('1.0a', '<', '1.0+'),
+        ('1.0z', '<', '1.0.'),
+        ('1.0', '<', '1.0+b1'),
+        ('1.0', '<', '1.0a'),
+        ('9.9', '<', '1:0.1'),
+        ('1:9.9', '<', '2:0.1'),
+        ('0:1.0', '=', '1.0'),
+        ('1.0-2-1', '<', '1.0-2-2'),
+        ('1.0-9', '<', '1.0-10'),
+        ('1.0-1', '<', '1.0.1-0'),
+        ('1.01', '=', '1.1'),
+        ('1.0-01', '=', '1.0-1'),
+        ('0', '<', '0.0'),
+        ('1.0', '<', '1.0-0.1'),
+        ('1.0', '=', '1.0-0'),
+        ('1.0', '<', '1.0-1'),
+    ]
+
+    def test_dpkg_order(self):
+        key = debian_pkg_manager.debian_version_key
+        for lower, relation, higher in self.table:
+            if relation == '=':
+                self.assertEqual(key(lower), key(higher), '{0} = {1}'.format(lower, higher))
+            else:
+                self.assertLess(key(lower), key(higher), '{0} < {1}'.format(lower, higher))
+                self.assertGreater(key(higher), key(lower), '{0} > {1}'.format(higher, lower))
+
+    def test_debian_version_compare(self):
+        compare = debian_pkg_manager.DebianPkgManager.debian_version_compare.im_func
+        self.assertEqual(compare(None, '1.0~rc1', '1.0'), '1.0')
+        self.assertEqual(compare(None, '2a', '2'), '2a')
+        self.assertIsNone(compare(None, '1.01', '1.1'))
+
+
+class PackageRecordTest(unittest.TestCase):
+
+    stanza = ('Package: foo\n'
+              'Architecture: amd64\n'
+              'Version: 1.0-1\n'
+              'Maintainer: Someone <someone@example.org>\n'
+              'Description: a foo\n'
+              ' which is long\n'
+              ' .\n'
+              ' and wrapped\n'
+              'Filename: pool/main/f/foo/foo_1.0-1_amd64.deb\n'
+              'Size: 1234\n'
+              'Tag: role::program\n')
+
+    def record(self, text=None):
+        # read_package_record does not use any manager state.
+        reader = debian_pkg_manager.DebianPkgManager.read_package_record.im_func
+        return reader(None, StringIO.StringIO((text or self.stanza) + '\nPackage: next\n'))
+
+    def test_fields_are_read_from_the_stanza(self):
+        record = self.record()
+        self.assertEqual(record['Version'], '1.0-1')
+        self.assertEqual(record['Description'], 'a foowhich is long.and wrapped')
+        self.assertEqual(record['Tag'], 'role::program')
+        self.assertEqual(list(record), ['Package', 'Architecture', 'Version', 'Maintainer', 'Description',
+                                        'Filename', 'Size', 'Tag'])
+        self.assertEqual(len(record), 8)
+        self.assertNotIn('Depends', record)
+        self.assertRaises(KeyError, record.__getitem__, 'Depends')
+
+    def test_stanza_passes_through_with_only_filename_patched(self):
+        record = self.record()
+        self.assertEqual(record.stanza_text(), self.stanza)
+        record['Filename'] = 'pool/f/foo_1.0-1_amd64.deb'
+        self.assertEqual(record.stanza_text(), self.stanza.replace('pool/main/f/foo/', 'pool/f/'))
+        self.assertEqual(record['Filename'], 'pool/f/foo_1.0-1_amd64.deb')
+
+    def test_changes_keep_the_stanza_and_slots_in_step(self):
+        record = self.record()
+        record['Description'] = 'short'
+        record['Depends'] = 'libc6'
+        del record['Tag']
+        record['Filename'] = 'pool/foo.deb'
+        self.assertEqual(record.stanza_text(),
+                         'Package: foo\nArchitecture: amd64\nVersion: 1.0-1\n'
+                         'Maintainer: Someone <someone@example.org>\nDescription: short\n'
+                         'Filename: pool/foo.deb\nSize: 1234\nDepends: libc6\n')
+        self.assertEqual(record['Depends'], 'libc6')
+        del record['Filename']
+        self.assertNotIn('Filename', record)
+        self.assertNotIn('Filename:', record.stanza_text())
+
+    def test_records_built_from_dictionaries_and_pickles(self):
+        record = debian_pkg_manager.PackageRecord([('Package', 'bar'), ('Version', '2'), ('Homepage', 'x')])
+        self.assertEqual(record.stanza_text(), 'Package: bar\nVersion: 2\nHomepage: x\n')
+        copy = cPickle.loads(cPickle.dumps(self.record(), cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy.stanza_text(), self.stanza)
+        self.assertEqual(copy['Maintainer'], 'Someone <someone@example.org>')
+
+
+class MergeDiffTest(unittest.TestCase):
+
+    def records(self, *pairs):
+        return [{'Package': name, 'Version': version} for name, version in pairs]
+
+    def diff(self, new, old):
+        return [(status, (new_record or old_record)['Package'])
+                for status, new_record, old_record in debian_pkg_manager.merge_diff_pkg_records(new, old)]
+
+    def test_statuses(self):
+        new = self.records(('a', '1'), ('b', '2.0'), ('c', '1'), ('e', '1~rc1'))
+        old = self.records(('b', '1.9'), ('c', '1'), ('d', '1'), ('e', '1'))
+        self.assertEqual(self.diff(new, old), [('added', 'a'), ('upgraded', 'b'), ('unchanged', 'c'),
+                                               ('removed', 'd'), ('unchanged', 'e')])
+
+    def test_empty_streams(self):
+        self.assertEqual(self.diff([], self.records(('a', '1'))), [('removed', 'a')])
+        self.assertEqual(self.diff(self.records(('a', '1')), []), [('added', 'a')])
+        self.assertEqual(self.diff([], []), [])
+
+    def test_repeated_names_resolve_to_the_last_record(self):
+        new = self.records(('a', '1'), ('a', '3'), ('b', '1'))
+        old = self.records(('a', '2'), ('b', '1'), ('b', '0'))
+        diff = list(debian_pkg_manager.merge_diff_pkg_records(new, old))
+        self.assertEqual([(status, new_record['Version']) for status, new_record, old_record in diff],
+                         [('upgraded', '3'), ('upgraded', '1')])
+
+    def test_unsorted_stream_is_rejected(self):
+        self.assertRaises(ValueError, self.diff, self.records(('b', '1'), ('a', '1')), [])
+
+
+class EdPatchTest(unittest.TestCase):
+
+    old = ('Package: a\nVersion: 1\nFilename: pool/a_1.deb\n\n'
+           'Package: b\nVersion: 1\nDescription: bee\n line two\n\n'
+           'Package: c\nVersion: 3\n')
+    new = ('Package: a\nVersion: 2\nFilename: pool/a_2.deb\n\n'
+           'Package: aa\nVersion: 1\n\n'
+           'Package: b\nVersion: 1\nDescription: bee\n line two\n line three\n')
+    # Output of diff --ed old new.
+    patch = ('9,11c\n line three\n.\n'
+             '3d\n'
+             '1a\nVersion: 2\nFilename: pool/a_2.deb\n\nPackage: aa\n.\n')
+
+    def patched(self, old, patch):
+        lines = old.splitlines(True)
+        debian_pkg_manager.apply_ed_patch(lines, patch)
+        return ''.join(lines)
+
+    def test_diff_output_round_trips(self):
+        self.assertEqual(self.patched(self.old, self.patch), self.new)
+
+    def test_live_diff_output_round_trips(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            old_path = os.path.join(temp_dir, 'old')
+            new_path = os.path.join(temp_dir, 'new')
+            for path, data in ((old_path, self.old), (new_path, self.new + self.old)):
+                stream = open(path, 'w')
+                stream.write(data)
+                stream.close()
+            try:
+                process = subprocess.Popen(['diff', '--ed', old_path, new_path], stdout=subprocess.PIPE)
+            except OSError:
+                self.skipTest('diff is not available')
+            patch = process.communicate()[0]
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(self.patched(self.old, patch), self.new + self.old)
+
+    def test_pdiff_index_patch_precedence(self):
+        index = ('SHA256-Current: ccc 30\n'
+                 'SHA256-History:\n aaa 10 T-1\n bbb 20 T-2\n'
+                 'SHA256-Patches:\n ppp 3 T-1\n qqq 4 T-2\n')
+        parsed = debian_pkg_manager.parse_pdiff_index(index)
+        self.assertEqual(parsed['history'], [['aaa', '10', 'T-1'], ['bbb', '20', 'T-2']])
+        self.assertEqual(parsed['patches'], {'T-1': ['ppp', '3'], 'T-2': ['qqq', '4']})
+        self.assertFalse(parsed['merged'])
+        self.assertTrue(debian_pkg_manager.parse_pdiff_index(index + 'X-Patch-Precedence: merged\n')['merged'])
+
+    def test_unsupported_command_is_rejected(self):
+        self.assertRaises(ValueError, self.patched, self.old, '1,$s/a/b/\n')
+
+
+if __name__ == '__main__':
+    unittest.main()